@@ -0,0 +1,366 @@
+import argparse
+import json
+import os
+import platform as host_platform
+import subprocess
+import sys
+import time
+
+# ダミーのビデオドライバーで動かすので、pygameより先に設定する
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+import suzacquegame as game
+
+BENCH_VERSION = 2
+DEFAULT_FRAMES = 600
+DEFAULT_WARMUP = 60
+DEFAULT_TOLERANCE = 0.10
+# ゲームの描画品質の段階（自動調整はしない）
+DEFAULT_QUALITY = game.QUALITY_TIERS[0].name
+# これより小さい差はノイズとして扱う（ミリ秒）
+DEFAULT_MIN_DELTA_MS = 0.02
+# 起動（プロセス開始から最初のフレームを出すまで）の目標時間
+STARTUP_TARGET_MS = 750.0
+DEFAULT_STARTUP_RUNS = 5
+
+# フェーズはゲームのフレームプロファイラーのもの（World.step と draw_world の中で区切られる）
+UPDATE_PHASES = ("player", "enemies", "streaming")
+DRAW_PHASES = ("background", "platforms", "coins", "particles", "enemy_draw", "player_draw", "hud", "flip")
+
+GROUND_TOP = 708
+PLAYER_START = (40, 500)
+# 敵やコインや足場はプレイヤーに触れない、画面上部に並べる
+FIELD_LEFT = 150
+FIELD_TOP = 60
+FIELD_BOTTOM = 540
+# コインが1枚もないとクリア済みになって勝利画面が重なるので、プレイヤーの届かない所に1枚置く
+SPARE_COIN = (game.SCREEN_WIDTH - game.COIN_SIZE - 10, 10)
+
+def _ground():
+    return [(0, GROUND_TOP, game.SCREEN_WIDTH, game.SCREEN_HEIGHT - GROUND_TOP, "ground")]
+
+def _field_positions(count, width, height):
+    # countの点を画面上部の格子に敷き詰める
+    columns = max(1, min(count, (game.SCREEN_WIDTH - FIELD_LEFT - width) // (width + 10) + 1))
+    rows = -(-count // columns)
+    step_x = (game.SCREEN_WIDTH - FIELD_LEFT - width) / max(columns - 1, 1)
+    step_y = (FIELD_BOTTOM - FIELD_TOP - height) / max(rows - 1, 1)
+    return [(int(FIELD_LEFT + (i % columns) * step_x), int(FIELD_TOP + (i // columns) * step_y))
+            for i in range(count)]
+
+def _level(platforms=(), enemies=(), coins=()):
+    return game.Level(game.SCREEN_WIDTH, game.SCREEN_HEIGHT, PLAYER_START,
+                      _ground() + list(platforms), list(enemies), list(coins) or [SPARE_COIN])
+
+# シナリオ
+# どれも「ワールドを作る関数」と「毎フレームの入力を返す関数」を返す
+def scenario_default(n):
+    return game.World(game.load_level()), lambda world: game.INPUTS_BY_BITS[game.INPUT_RIGHT | game.INPUT_JUMP]
+
+def scenario_enemies(n):
+    # 棚の上を敵が往復する
+    shelves = []
+    enemies = []
+    for x, y in _field_positions(max(1, n // 4), 200, 20):
+        shelves.append((x, y + game.ENEMY_HEIGHT, 200, 20, "brick"))
+    for i in range(n):
+        x, y, w, h, _ = shelves[i % len(shelves)]
+        enemies.append((x + (i * 37) % (w - game.ENEMY_WIDTH), y - game.ENEMY_HEIGHT))
+    return game.World(_level(platforms=shelves, enemies=enemies)), None
+
+def scenario_coins(n):
+    return game.World(_level(coins=_field_positions(n, game.COIN_SIZE, game.COIN_SIZE))), None
+
+def scenario_platforms(n):
+    bricks = [(x, y, 40, 20, "brick") for x, y in _field_positions(n, 40, 20)]
+    return game.World(_level(platforms=bricks)), None
+
+def scenario_feathers(n):
+    world = game.World(_level())
+    player = world.player
+    player.feathers = game.ParticleSystem(n, game.render_feather, gravity=0.3, spin=5,
+                                          rotation_period=120)
+
+    def refill(world):
+        # 寿命で消えた分を毎フレーム補充して、常にn枚飛んでいる状態にする
+        feathers = world.player.feathers
+        rng = world.effects_rng
+        while feathers.emit(rng.uniform(0, game.SCREEN_WIDTH), rng.uniform(FIELD_TOP, FIELD_BOTTOM),
+                            rng.uniform(-3, 3), rng.uniform(-5, -2),
+                            rng.randint(1, game.FEATHER_LIFE), rng.uniform(0, 360)):
+            pass
+        return game.NO_INPUT
+    return world, refill
+
+def scenario_game_over(n):
+    world, _ = scenario_enemies(n)
+    world.game_over = True
+    return world, None
+
+SCENARIOS = {
+    "default": scenario_default,
+    "enemies": scenario_enemies,
+    "coins": scenario_coins,
+    "platforms": scenario_platforms,
+    "feathers": scenario_feathers,
+    "game_over": scenario_game_over,
+}
+
+# 粒子の数をシナリオの引数で決めるもの
+SIZED_POOL_SCENARIOS = ("feathers",)
+
+DEFAULT_SCENARIOS = ("default", "enemies:10", "enemies:100", "enemies:500",
+                     "coins:10", "coins:100", "coins:500",
+                     "platforms:100", "platforms:1000",
+                     "feathers:256", "feathers:2048", "game_over:10")
+
+def parse_scenario(spec):
+    name, _, count = spec.partition(":")
+    if name not in SCENARIOS:
+        raise ValueError(f"unknown scenario '{name}' (choose from {', '.join(SCENARIOS)})")
+    return name, int(count) if count else 0
+
+# 計測
+def _summary(samples):
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, max(0, -(-len(ordered) * 99 // 100) - 1))]
+    return {"mean_ms": sum(ordered) / len(ordered) / 1e6, "p99_ms": p99 / 1e6}
+
+def run_scenario(spec, frames=DEFAULT_FRAMES, warmup=DEFAULT_WARMUP, quality=DEFAULT_QUALITY):
+    # ゲームと同じ World.step と draw_world を動かし、フェーズごとの時間はプロファイラーから読む
+    name, count = parse_scenario(spec)
+    world, policy = SCENARIOS[name](count)
+    saved_level = game.quality.level
+    game.quality.set_mode(quality)
+    game.quality.apply(world)
+    if name in SIZED_POOL_SCENARIOS and game.quality.tier.feathers:
+        # 羽根の数を自分で決めるシナリオは段階の上限で削らない（羽根を切る段階だけ従う）
+        world.player.feathers.limit = world.player.feathers.capacity
+    # 内部解像度を下げる段階ではゲームと同じく小さいキャンバスに描いて画面へ拡大する
+    display = pygame.display.get_surface()
+    screen = game.render_target(display, game.quality.tier.scale)
+    profiler = game.FrameProfiler(frames)
+    profiler.enable()
+    saved_profiler, game.profiler = game.profiler, profiler
+    try:
+        for frame in range(warmup + frames):
+            if frame == warmup:
+                profiler.clear()
+            inputs = policy(world) if policy else game.NO_INPUT
+            profiler.begin_frame()
+            world.step(inputs)
+            game.draw_world(screen, world, frame)
+            game.draw_hud(screen, world)
+            profiler.mark(game.PHASE_HUD)
+            if screen is not display:
+                screen.present(display)
+            pygame.display.flip()
+            profiler.mark(game.PHASE_FLIP)
+            profiler.end_frame()
+            pygame.event.pump()
+            if world.game_over and name != "game_over":
+                world.reset()
+    finally:
+        game.profiler = saved_profiler
+        game.quality.set_level(saved_level)
+        world.level.close()
+
+    _, durations = profiler.frames()
+    result = {"scenario": name, "count": count, "frames": frames}
+    for stage, phases in (("update", UPDATE_PHASES), ("draw", DRAW_PHASES)):
+        columns = durations[:, [game.PROFILER_PHASES.index(phase) for phase in phases]]
+        result[stage] = _summary(columns.sum(axis=1).tolist())
+        result[stage]["phases"] = {phase: _summary(column) for phase, column in zip(phases, columns.T.tolist())}
+    return result
+
+def run_suite(specs=DEFAULT_SCENARIOS, frames=DEFAULT_FRAMES, warmup=DEFAULT_WARMUP, report=None,
+              quality=DEFAULT_QUALITY):
+    results = {}
+    for spec in specs:
+        results[spec] = run_scenario(spec, frames, warmup, quality)
+        if report:
+            report(spec, results[spec])
+    return {
+        "version": BENCH_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": host_platform.python_version(),
+        "pygame": pygame.version.ver,
+        "machine": host_platform.machine(),
+        "frames": frames,
+        "warmup": warmup,
+        "quality": quality,
+        "scenarios": results,
+    }
+
+# 起動時間
+# 毎回新しいプロセスを起動して、ゲームの main() と同じ手順で最初のフレームを出すまでを計る。
+# 親プロセスで計ったプロセス全体の時間から子の報告した時間を引いたものが、
+# インタープリターの起動とモジュールのインポートにかかった時間になる。
+def startup_child(cold=False):
+    start_time = time.perf_counter()
+    stages = {}
+    if cold:
+        # 縮小済み画像のディスクキャッシュを使わない
+        game.assets.cache_dir = None
+    screen = game.bootstrap(headless=True)
+    stages["bootstrap"] = time.perf_counter() - start_time
+    loader = game.Preloader(game.startup_tasks(game.DEFAULT_LEVEL_PATH, 0, screen.get_size()))
+    loader.run()
+    if loader.error:
+        raise loader.error
+    stages.update(loader.times)
+    frame_start = time.perf_counter()
+    world = loader.results["world"]
+    game.draw_world(screen, world, 1)
+    game.draw_hud(screen, world)
+    pygame.display.flip()
+    stages["first_frame"] = time.perf_counter() - frame_start
+    stages["total"] = time.perf_counter() - start_time
+    world.level.close()
+    return {name: seconds * 1000 for name, seconds in stages.items()}
+
+def measure_startup(runs=DEFAULT_STARTUP_RUNS, cold=False, report=None):
+    command = [sys.executable, os.path.abspath(__file__), "--startup-child"] + (["--cold"] if cold else [])
+    samples = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        wall_ms = (time.perf_counter() - start_time) * 1000
+        stages = json.loads(output.strip().splitlines()[-1])
+        stages["import"] = wall_ms - stages["total"]
+        stages["total"] = wall_ms
+        samples.append(stages)
+        if report:
+            report(stages)
+    result = {"runs": runs, "cold": cold, "target_ms": STARTUP_TARGET_MS}
+    for name in samples[0]:
+        values = sorted(sample[name] for sample in samples)
+        result[name] = {"mean_ms": sum(values) / len(values), "min_ms": values[0], "max_ms": values[-1]}
+    return result
+
+# 比較
+def _metrics(result):
+    # サブシステムごとのp99は揺れが大きいので、平均だけを比べる
+    for stage in ("update", "draw"):
+        for stat in ("mean_ms", "p99_ms"):
+            yield stage, stat, result[stage][stat]
+        for phase, summary in result[stage]["phases"].items():
+            yield f"{stage}.{phase}", "mean_ms", summary["mean_ms"]
+
+def _startup_metrics(result):
+    for name, summary in result.items():
+        if isinstance(summary, dict):
+            yield name, "mean_ms", summary["mean_ms"]
+
+def compare(current, baseline, tolerance=DEFAULT_TOLERANCE, min_delta_ms=DEFAULT_MIN_DELTA_MS):
+    regressions = []
+    improvements = []
+    pairs = [(spec, _metrics(result), baseline.get("scenarios", {}).get(spec), _metrics)
+             for spec, result in current.get("scenarios", {}).items()]
+    if "startup" in current:
+        pairs.append(("startup", _startup_metrics(current["startup"]), baseline.get("startup"), _startup_metrics))
+    for spec, metrics, base, base_metrics_of in pairs:
+        if base is None:
+            continue
+        base_metrics = {(metric, stat): value for metric, stat, value in base_metrics_of(base)}
+        for metric, stat, value in metrics:
+            old = base_metrics.get((metric, stat))
+            if old is None or abs(value - old) < min_delta_ms:
+                continue
+            row = (spec, metric, stat, old, value)
+            if value > old * (1 + tolerance):
+                regressions.append(row)
+            elif value < old * (1 - tolerance):
+                improvements.append(row)
+    return regressions, improvements
+
+def _print_result(spec, result):
+    print(f"{spec:<16} update {result['update']['mean_ms']:7.3f} ms (p99 {result['update']['p99_ms']:7.3f})"
+          f"   draw {result['draw']['mean_ms']:7.3f} ms (p99 {result['draw']['p99_ms']:7.3f})")
+    for stage in ("update", "draw"):
+        for phase, summary in result[stage]["phases"].items():
+            if summary["p99_ms"] >= 0.005:
+                print(f"    {stage + '.' + phase:<20} {summary['mean_ms']:7.3f} ms (p99 {summary['p99_ms']:7.3f})")
+
+def _print_startup(stages):
+    print("startup  " + "  ".join(f"{name} {ms:.0f} ms" for name, ms in stages.items()))
+
+def _print_rows(title, rows):
+    if rows:
+        print(title)
+        for spec, metric, stat, old, value in rows:
+            change = f"{(value / old - 1) * 100:+.0f}%" if old else "n/a"
+            print(f"  {spec:<16} {metric:<20} {stat:<8} {old:8.3f} -> {value:8.3f} ms ({change})")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="エンジェルアドベンチャー benchmark suite")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO[:N]",
+                        help=f"scenarios to run (default: all). available: {', '.join(SCENARIOS)}")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES, help="measured frames per scenario")
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help="unmeasured frames before measuring")
+    parser.add_argument("--quality", choices=[tier.name for tier in game.QUALITY_TIERS], default=DEFAULT_QUALITY,
+                        help=f"rendering quality tier to measure (default: {DEFAULT_QUALITY})")
+    parser.add_argument("--output", "-o", metavar="PATH", help="write the results as JSON")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against a stored JSON result")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="relative slowdown that counts as a regression (default: 0.10)")
+    parser.add_argument("--min-delta", type=float, default=DEFAULT_MIN_DELTA_MS, metavar="MS",
+                        help="ignore differences smaller than this many milliseconds")
+    parser.add_argument("--startup", type=int, nargs="?", const=DEFAULT_STARTUP_RUNS, metavar="RUNS",
+                        help=f"measure the time from process start to the first frame instead of the scenarios "
+                             f"and fail if it is over {STARTUP_TARGET_MS:.0f} ms")
+    parser.add_argument("--cold", action="store_true", help="with --startup, ignore the scaled image disk cache")
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup_child:
+        print(json.dumps(startup_child(args.cold)))
+        return 0
+    if args.startup:
+        results = {
+            "version": BENCH_VERSION,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": host_platform.python_version(),
+            "pygame": pygame.version.ver,
+            "machine": host_platform.machine(),
+            "startup": measure_startup(args.startup, args.cold, report=_print_startup),
+        }
+        total = results["startup"]["total"]["mean_ms"]
+        over_target = total > STARTUP_TARGET_MS
+        print(f"startup mean {total:.0f} ms (target {STARTUP_TARGET_MS:.0f} ms){' OVER TARGET' if over_target else ''}")
+    else:
+        game.bootstrap(headless=True)
+        specs = args.scenarios or DEFAULT_SCENARIOS
+        try:
+            for spec in specs:
+                parse_scenario(spec)
+        except ValueError as e:
+            print(e)
+            return 2
+        results = run_suite(specs, args.frames, args.warmup, report=_print_result, quality=args.quality)
+        over_target = False
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("version") != BENCH_VERSION:
+            print(f"note: the baseline was written by bench version {baseline.get('version')}; "
+                  f"phases missing from either side are not compared")
+        if baseline.get("quality", DEFAULT_QUALITY) != results.get("quality", DEFAULT_QUALITY):
+            print(f"note: the baseline was measured at quality {baseline.get('quality', DEFAULT_QUALITY)}")
+        regressions, improvements = compare(results, baseline, args.tolerance, args.min_delta)
+        _print_rows("improvements:", improvements)
+        _print_rows("REGRESSIONS:", regressions)
+        if regressions:
+            return 1
+        print("no regressions")
+    return 1 if over_target else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
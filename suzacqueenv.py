@@ -0,0 +1,337 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing import shared_memory
+
+# ワーカーはウィンドウを開かない。spawnで起動した子プロセスにもこの環境変数が引き継がれる
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+import pygame
+import suzacquegame as game
+
+# 行動は Inputs のビットマスク（左=1、右=2、ジャンプ=4）
+ACTION_COUNT = 8
+OBSERVATION_STATE = "state"
+OBSERVATION_FRAMES = "frames"
+DEFAULT_FRAME_SIZE = (128, 96)
+DEFAULT_MAX_STEPS = 60 * 60
+
+REWARD_COIN = 1.0
+REWARD_WIN = 10.0
+REWARD_DEATH = -5.0
+
+# 状態ベクトル: プレイヤー9個 + 近い敵 (dx, dy, vel_x) + 近いコイン (dx, dy)
+STATE_NEAREST_ENEMIES = 4
+STATE_NEAREST_COINS = 4
+STATE_SIZE = 9 + STATE_NEAREST_ENEMIES * 3 + STATE_NEAREST_COINS * 2
+# 近くに何もない時の相対位置
+STATE_FAR = 10000.0
+
+def observe_state(world, out):
+    player = world.player
+    px, py = player.rect.center
+    out[:9] = (player.x, player.y, player.vel_x, player.vel_y, player.on_ground,
+               world.coins_collected / max(world.coin_count, 1), world.game_over, world.won, world.frame)
+    out[9:] = STATE_FAR
+    pos = 9
+    for store, count, extra in ((world.enemies, STATE_NEAREST_ENEMIES, True),
+                                (world.coins, STATE_NEAREST_COINS, False)):
+        n = len(store)
+        columns = 3 if extra else 2
+        if n:
+            dx = store.left[:n] + store.width // 2 - px
+            dy = store.top[:n] + store.height // 2 - py
+            distance = np.abs(dx) + np.abs(dy)
+            nearest = np.argsort(distance, kind="stable")[:count]
+            block = out[pos:pos + count * columns].reshape(count, columns)
+            block[:len(nearest), 0] = dx[nearest]
+            block[:len(nearest), 1] = dy[nearest]
+            if extra:
+                block[:len(nearest), 2] = store.vel_x[nearest]
+        pos += count * columns
+
+# 共有メモリ
+# 観測・行動・報酬・終了フラグはワーカーと共有する配列に直接書く。
+# パイプで送るのは1バイトのコマンドだけなので、1ステップの通信は往復1回で済む。
+class SharedArrays:
+    def __init__(self, specs, names=None):
+        self.blocks = {}
+        self.arrays = {}
+        for name, (shape, dtype) in specs.items():
+            size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            if names is None:
+                block = shared_memory.SharedMemory(create=True, size=size)
+            else:
+                block = shared_memory.SharedMemory(name=names[name])
+            self.blocks[name] = block
+            self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    @property
+    def names(self):
+        return {name: block.name for name, block in self.blocks.items()}
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self, unlink=False):
+        self.arrays.clear()
+        for block in self.blocks.values():
+            try:
+                block.close()
+            except BufferError:
+                # 呼び出し側がまだ観測のビューを持っている
+                pass
+            if unlink:
+                block.unlink()
+        self.blocks.clear()
+
+def _specs(num_envs, observation, frame_size):
+    if observation == OBSERVATION_FRAMES:
+        # BGRX の32ビット。描画先のサーフェスをこの上に直接作る
+        obs = ((num_envs, frame_size[1], frame_size[0], 4), np.uint8)
+    else:
+        obs = ((num_envs, STATE_SIZE), np.float32)
+    return {
+        "observations": obs,
+        "actions": ((num_envs,), np.uint8),
+        "rewards": ((num_envs,), np.float32),
+        "dones": ((num_envs,), np.bool_),
+    }
+
+# ワーカー
+# 連続したK個のうち [start, stop) のワールドを受け持つ
+class WorldSlice:
+    def __init__(self, shared, start, stop, config):
+        self.shared = shared
+        self.start = start
+        self.stop = stop
+        self.observation = config["observation"]
+        self.max_steps = config["max_steps"]
+        self.frame_skip = config["frame_skip"]
+        level = game.load_level(config["level_path"])
+        self.worlds = [game.World(level, seed=config["seed"] + i) for i in range(start, stop)]
+        self.steps = [0] * len(self.worlds)
+        self.canvas = None
+        self.targets = []
+        if self.observation == OBSERVATION_FRAMES:
+            # 画像を画面と同じ形式に変換しておくため、見えない画面を作る
+            game.bootstrap(headless=True)
+            self.canvas = pygame.Surface((game.SCREEN_WIDTH, game.SCREEN_HEIGHT), 0, 32)
+            frames = shared["observations"]
+            width, height = config["frame_size"]
+            # 共有メモリをそのまま画素として使うサーフェス。縮小結果がコピーなしで観測になる
+            self.targets = [pygame.image.frombuffer(frames[i].data, (width, height), "BGRA")
+                            for i in range(start, stop)]
+
+    def observe(self, i):
+        world = self.worlds[i]
+        index = self.start + i
+        if self.observation == OBSERVATION_FRAMES:
+            game.draw_world(self.canvas, world, world.frame)
+            target = self.targets[i]
+            pygame.transform.smoothscale(self.canvas, target.get_size(), target)
+        else:
+            observe_state(world, self.shared["observations"][index])
+
+    def reset(self):
+        for i, world in enumerate(self.worlds):
+            world.reset()
+            self.steps[i] = 0
+            self.observe(i)
+        self.shared["rewards"][self.start:self.stop] = 0
+        self.shared["dones"][self.start:self.stop] = False
+
+    def step(self):
+        actions = self.shared["actions"]
+        rewards = self.shared["rewards"]
+        dones = self.shared["dones"]
+        for i, world in enumerate(self.worlds):
+            index = self.start + i
+            inputs = game.Inputs.from_bits(int(actions[index]) & 7)
+            coins = world.coins_collected
+            for _ in range(self.frame_skip):
+                world.step(inputs)
+                if world.game_over or world.won:
+                    break
+            self.steps[i] += 1
+            reward = (world.coins_collected - coins) * REWARD_COIN
+            if world.game_over:
+                reward += REWARD_DEATH
+            elif world.won:
+                reward += REWARD_WIN
+            done = world.game_over or world.won or self.steps[i] >= self.max_steps
+            rewards[index] = reward
+            dones[index] = done
+            # 終わったワールドはその場でリセットして、次のエピソードの最初の観測を返す
+            if done:
+                world.reset()
+                self.steps[i] = 0
+            self.observe(i)
+
+    def close(self):
+        self.targets = []
+        for world in self.worlds:
+            world.level.close()
+
+def _worker(conn, names, specs, start, stop, config):
+    shared = None
+    worlds = None
+    try:
+        shared = SharedArrays(specs, names)
+        worlds = WorldSlice(shared, start, stop, config)
+        while True:
+            command = conn.recv_bytes()
+            if command == b"s":
+                worlds.step()
+            elif command == b"r":
+                worlds.reset()
+            else:
+                break
+            conn.send_bytes(b"")
+    except (EOFError, KeyboardInterrupt):
+        pass
+    except Exception:
+        # 親の次の返事の代わりに送り、親の _run() で投げ直させる
+        conn.send_bytes(b"e" + traceback.format_exc().encode("utf-8"))
+    finally:
+        if worlds is not None:
+            worlds.close()
+        if shared is not None:
+            shared.close()
+        conn.close()
+
+# 並列環境
+class VectorEnv:
+    def __init__(self, num_envs, workers=None, observation=OBSERVATION_STATE,
+                 frame_size=DEFAULT_FRAME_SIZE, level_path=game.DEFAULT_LEVEL_PATH, seed=0,
+                 max_steps=DEFAULT_MAX_STEPS, frame_skip=1):
+        if observation not in (OBSERVATION_STATE, OBSERVATION_FRAMES):
+            raise ValueError(f"unknown observation type '{observation}'")
+        self.num_envs = num_envs
+        # workers=0 ならこのプロセスの中で全部動かす（デバッグ用）
+        workers = min(os.cpu_count() or 1, num_envs) if workers is None else min(workers, num_envs)
+        self.observation = observation
+        specs = _specs(num_envs, observation, frame_size)
+        config = {"observation": observation, "frame_size": tuple(frame_size), "level_path": level_path,
+                  "seed": seed, "max_steps": max_steps, "frame_skip": frame_skip}
+        bounds = np.linspace(0, num_envs, max(workers, 1) + 1).astype(int).tolist()
+        self.local = None
+        self.connections = []
+        self.processes = []
+        self.closed = False
+        self.shared = SharedArrays(specs)
+        # ここから先で失敗したら、作った共有メモリとワーカーを片付けてから投げ直す
+        try:
+            if workers == 0:
+                self.local = WorldSlice(self.shared, 0, num_envs, config)
+            else:
+                context = multiprocessing.get_context("spawn")
+                for start, stop in zip(bounds, bounds[1:]):
+                    parent, child = context.Pipe()
+                    process = context.Process(target=_worker,
+                                              args=(child, self.shared.names, specs, start, stop, config),
+                                              daemon=True)
+                    process.start()
+                    child.close()
+                    self.connections.append(parent)
+                    self.processes.append(process)
+        except BaseException:
+            self.close()
+            raise
+
+    @property
+    def observations(self):
+        # 共有メモリのビュー。次の reset()/step() で上書きされる
+        obs = self.shared["observations"]
+        if self.observation == OBSERVATION_FRAMES:
+            return obs[..., 2::-1]
+        return obs
+
+    def _run(self, command):
+        if self.local is not None:
+            self.local.step() if command == b"s" else self.local.reset()
+            return
+        for conn in self.connections:
+            try:
+                conn.send_bytes(command)
+            except (BrokenPipeError, OSError):
+                # 失敗して終わったワーカー。送ってあったエラーを下で受け取る
+                pass
+        # 全員の返事を受け取ってから投げる（残った返事で次の呼び出しがずれないように）
+        errors = []
+        for conn in self.connections:
+            try:
+                reply = conn.recv_bytes()
+            except (EOFError, OSError):
+                reply = b"eworker exited without a reply\n"
+            if reply.startswith(b"e"):
+                errors.append(reply[1:].decode("utf-8", "replace"))
+        if errors:
+            raise RuntimeError("environment worker failed:\n" + errors[0])
+
+    def reset(self):
+        self._run(b"r")
+        return self.observations
+
+    def step(self, actions):
+        self.shared["actions"][:] = actions
+        self._run(b"s")
+        return self.observations, self.shared["rewards"], self.shared["dones"]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self.connections:
+            try:
+                conn.send_bytes(b"q")
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for conn in self.connections:
+            conn.close()
+        if self.local is not None:
+            self.local.close()
+        self.shared.close(unlink=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def benchmark(num_envs, workers, observation, steps, seed=0):
+    rng = np.random.default_rng(seed)
+    with VectorEnv(num_envs, workers, observation, seed=seed) as env:
+        env.reset()
+        actions = rng.integers(0, ACTION_COUNT, size=(steps, num_envs), dtype=np.uint8)
+        start = time.perf_counter()
+        for row in actions:
+            env.step(row)
+        elapsed = time.perf_counter() - start
+    return num_envs * steps / elapsed
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="エンジェルアドベンチャー vectorized environment")
+    parser.add_argument("--envs", type=int, default=8, help="number of worlds")
+    parser.add_argument("--workers", type=int, nargs="+", default=None,
+                        help="worker process counts to measure (0 runs in this process)")
+    parser.add_argument("--observation", choices=(OBSERVATION_STATE, OBSERVATION_FRAMES), default=OBSERVATION_STATE)
+    parser.add_argument("--steps", type=int, default=2000, help="steps per measurement")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    for workers in args.workers or [0, os.cpu_count() or 1]:
+        rate = benchmark(args.envs, workers, args.observation, args.steps)
+        print(f"{args.envs} envs, {workers} workers, {args.observation}: {rate:.0f} env steps/s")
+    sys.exit(0)
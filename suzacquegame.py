@@ -1,16 +1,29 @@
-import pygame
+import argparse
+import gc
+import os
 import sys
+import pygame
 import math
 import random
-
-# Pygameの初期化
-pygame.init()
+import time
+import hashlib
+import json
+import struct
+import queue
+import threading
+import tracemalloc
+import weakref
+import zlib
+from bisect import bisect_left, bisect_right, insort
+from collections import deque, namedtuple, OrderedDict
+import numpy as np
 
 # 画面設定
+# インポートしただけではpygameを初期化せず、画面と時計は bootstrap() で作る
 SCREEN_WIDTH = 1024
 SCREEN_HEIGHT = 768
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("エンジェルアドベンチャー")
+WINDOW_TITLE = "エンジェルアドベンチャー"
+screen = None
 
 # 色の定義
 SKY_BLUE = (135, 206, 250)
@@ -41,38 +54,298 @@ TREE_LEAF_DARK = (40, 150, 40)
 TREE_TRUNK = (100, 80, 60)
 
 # ゲーム設定
-clock = pygame.time.Clock()
+# シミュレーションは描画とは別に固定の刻み（SIM_RATE回/秒）で進める。
+# 重力・ジャンプ力・摩擦などの定数は全てこの1ステップあたりの値。
+# 描画が遅れた分はまとめて追いつくが、MAX_CATCH_UP_STEPS を超えた分は捨てる（遅れが遅れを呼ばないように）。
+clock = None
 FPS = 60
+SIM_RATE = 60
+SIM_DT = 1.0 / SIM_RATE
+MAX_CATCH_UP_STEPS = 5
 GRAVITY = 0.8
 JUMP_STRENGTH = -15
+PLAYER_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "suzacque.png")
+PLAYER_IMAGE_DIVISOR = 10
+
+# アセット管理
+# 画像は一度だけ読み込んで変換し、縮小・左右反転などの加工済みの版もまとめて保持する。
+# 縮小結果は元ファイルのハッシュをキーにしてディスクにも保存し、次回起動時のsmoothscaleを省く。
+ASSET_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".asset_cache")
+ASSET_CACHE_MAGIC = b"SZQ1"
+ASSET_CACHE_HEADER = struct.Struct("<4sII4s")
+
+class AssetManager:
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.images = {}
+        self.scaled_images = {}
+        self.variants = {}
+
+    def load(self, path):
+        image = self.images.get(path)
+        if image is None:
+            image = self.images[path] = pygame.image.load(path)
+        return image
+
+    def _cache_path(self, path, divisor):
+        try:
+            with open(path, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            return None
+        return os.path.join(self.cache_dir, f"{digest}_div{divisor}.bin")
+
+    def _read_cache(self, cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        # 壊れたファイルや別のファイルは無かった事にして、縮小し直して書き直す
+        if len(data) < ASSET_CACHE_HEADER.size or data[:len(ASSET_CACHE_MAGIC)] != ASSET_CACHE_MAGIC:
+            return None
+        try:
+            _, width, height, pixel_format = ASSET_CACHE_HEADER.unpack_from(data)
+            pixel_format = pixel_format.rstrip(b"\0").decode("ascii")
+            pixels = data[ASSET_CACHE_HEADER.size:]
+            if not pixel_format or len(pixels) != width * height * len(pixel_format):
+                return None
+            return pygame.image.frombytes(pixels, (width, height), pixel_format)
+        except (ValueError, UnicodeDecodeError, pygame.error, struct.error):
+            return None
+
+    def _write_cache(self, cache_path, surface):
+        pixel_format = "RGBA" if surface.get_flags() & pygame.SRCALPHA else "RGB"
+        header = ASSET_CACHE_HEADER.pack(ASSET_CACHE_MAGIC, surface.get_width(), surface.get_height(),
+                                         pixel_format.encode("ascii"))
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(header)
+                f.write(pygame.image.tobytes(surface, pixel_format))
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass
+
+    def scaled(self, path, divisor=1):
+        # 幅と高さをdivisorで割った大きさに縮小した画像（変換前）
+        key = (path, divisor)
+        image = self.scaled_images.get(key)
+        if image is not None:
+            return image
+        cache_path = None
+        if self.cache_dir and divisor != 1:
+            cache_path = self._cache_path(path, divisor)
+            image = self._read_cache(cache_path) if cache_path else None
+        if image is None:
+            image = self.load(path)
+            if divisor != 1:
+                size = (max(1, image.get_width() // divisor), max(1, image.get_height() // divisor))
+                image = pygame.transform.smoothscale(image, size)
+                if cache_path:
+                    self._write_cache(cache_path, image)
+        self.scaled_images[key] = image
+        return image
+
+    def sprite(self, path, divisor=1, colorkey=None, flip_x=False):
+        key = (path, divisor, colorkey, flip_x)
+        surface = self.variants.get(key)
+        if surface is None:
+            if flip_x:
+                surface = pygame.transform.flip(self.sprite(path, divisor, colorkey), True, False)
+            else:
+                surface = self.scaled(path, divisor).copy()
+                if colorkey is not None:
+                    surface.set_colorkey(colorkey)
+                surface = _to_display_format(surface, alpha=True)
+            self.variants[key] = surface
+        return surface
+
+assets = AssetManager(ASSET_CACHE_DIR)
+
+# 入力
+# シミュレーションはキーボードではなくこの構造体だけを見る。
+# 記録・再生のために1バイトのビットマスクとも相互に変換できる。
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_JUMP = 4
+INPUT_RESTART = 8
+
+class Inputs:
+    __slots__ = ('left', 'right', 'jump', 'restart')
+
+    def __init__(self, left=False, right=False, jump=False, restart=False):
+        self.left = left
+        self.right = right
+        self.jump = jump
+        self.restart = restart
+
+    @classmethod
+    def from_keys(cls, keys, restart=False):
+        # 毎ステップ作らず、共有のインスタンスを返す
+        return INPUTS_BY_BITS[(INPUT_LEFT if keys[pygame.K_LEFT] else 0) |
+                              (INPUT_RIGHT if keys[pygame.K_RIGHT] else 0) |
+                              (INPUT_JUMP if keys[pygame.K_SPACE] else 0) |
+                              (INPUT_RESTART if restart else 0)]
+
+    @classmethod
+    def from_bits(cls, bits):
+        return INPUTS_BY_BITS[bits & 15]
+
+    def to_bits(self):
+        return ((INPUT_LEFT if self.left else 0) | (INPUT_RIGHT if self.right else 0) |
+                (INPUT_JUMP if self.jump else 0) | (INPUT_RESTART if self.restart else 0))
+
+INPUTS_BY_BITS = [Inputs(bool(bits & INPUT_LEFT), bool(bits & INPUT_RIGHT), bool(bits & INPUT_JUMP),
+                         bool(bits & INPUT_RESTART)) for bits in range(16)]
+NO_INPUT = INPUTS_BY_BITS[0]
+
+# パーティクル
+# 固定容量のNumPy配列（構造体の配列ではなく配列の構造体）に粒子を持ち、
+# 全粒子の移動・重力・寿命・回転を一度にまとめて進める。
+# 描画は寿命と回転の組ごとに一度だけ作ったスプライトをblitする。
+FEATHER_LIFE = 30
+SPARKLE_LIFE = 20
+
+def render_feather(life, rotation):
+    alpha = life / FEATHER_LIFE
+    size = int(10 * alpha)
+    if size <= 0:
+        return None
+    feather_color = (255, int(255 * alpha), int(255 * alpha))
+    surface = _keyed_surface((size * 2 + 1, size * 2 + 1))
+    points = []
+    for i in range(6):
+        angle = (i * 60 + rotation) * math.pi / 180
+        r = size if i % 2 == 0 else size // 2
+        points.append((size + r * math.cos(angle), size + r * math.sin(angle)))
+    pygame.draw.polygon(surface, feather_color, points)
+    return _to_display_format(surface), (size, size)
+
+def render_sparkle(life, rotation):
+    size = life // 5
+    if size <= 0:
+        return None
+    surface = _keyed_surface((size * 2 + 1, size * 2 + 1))
+    pygame.draw.circle(surface, YELLOW, (size, size), size)
+    return _to_display_format(surface), (size, size)
+
+class ParticleSystem:
+    def __init__(self, capacity, render, gravity=0.0, spin=0.0,
+                 rotation_period=360, rotation_step=5):
+        self.capacity = capacity
+        self.render = render
+        self.gravity = gravity
+        self.spin = spin
+        self.rotation_period = rotation_period
+        self.rotation_step = rotation_step
+        self.count = 0
+        # 品質の段階で変わる上限（capacity以下）
+        self.limit = capacity
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.vel_x = np.zeros(capacity)
+        self.vel_y = np.zeros(capacity)
+        self.rotation = np.zeros(capacity)
+        self.life = np.zeros(capacity, dtype=np.int32)
+        self.arrays = (self.x, self.y, self.vel_x, self.vel_y, self.rotation, self.life)
+        self.sprites = {}
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+
+    def emit(self, x, y, vel_x=0.0, vel_y=0.0, life=FEATHER_LIFE, rotation=0.0):
+        # 満杯の時は新しい粒子を捨てる
+        i = self.count
+        if i >= self.limit:
+            return False
+        self.x[i] = x
+        self.y[i] = y
+        self.vel_x[i] = vel_x
+        self.vel_y[i] = vel_y
+        self.rotation[i] = rotation
+        self.life[i] = life
+        self.count = i + 1
+        return True
+
+    def step(self):
+        n = self.count
+        if not n:
+            return
+        self.x[:n] += self.vel_x[:n]
+        self.y[:n] += self.vel_y[:n]
+        if self.gravity:
+            self.vel_y[:n] += self.gravity
+        self.life[:n] -= 1
+        if self.spin:
+            self.rotation[:n] += self.spin
+        # 死んだ粒子を詰める（順序は保つ）
+        alive = self.life[:n] > 0
+        remaining = int(np.count_nonzero(alive))
+        if remaining < n:
+            for array in self.arrays:
+                array[:remaining] = array[:n][alive]
+            self.count = remaining
+
+    def sprite(self, key):
+        # keyは life * バケット数 + 回転バケット
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            buckets = self.rotation_period // self.rotation_step
+            rendered = self.render(key // buckets, key % buckets * self.rotation_step)
+            sprite = self.sprites[key] = rendered or (None, (0, 0))
+        return sprite
+
+    def draw(self, screen, offset=(0, 0)):
+        n = self.count
+        if not n:
+            return []
+        buckets = self.rotation_period // self.rotation_step
+        keys = self.life[:n] * buckets + ((self.rotation[:n] % self.rotation_period) // self.rotation_step).astype(np.int32)
+        sprites = self.sprites
+        sprite = self.sprite
+        blits = []
+        append = blits.append
+        dx, dy = offset
+        for key, x, y in zip(keys.tolist(), self.x[:n].astype(np.int32).tolist(),
+                             self.y[:n].astype(np.int32).tolist()):
+            surface, (ox, oy) = sprites.get(key) or sprite(key)
+            if surface is not None:
+                append((surface, (x - ox - dx, y - oy - dy)))
+        return screen.blits(blits)
 
 class Player:
-    def __init__(self, x, y):
+    def __init__(self, x, y, rng=None):
         self.x = x
         self.y = y
+        self.rng = rng if rng is not None else random.Random()
         try:
-            loaded_image = pygame.image.load("suzacque.png")
+            self.image_orig = assets.sprite(PLAYER_IMAGE, divisor=PLAYER_IMAGE_DIVISOR, colorkey=CREAM)
+            self.image_flipped = assets.sprite(PLAYER_IMAGE, divisor=PLAYER_IMAGE_DIVISOR, colorkey=CREAM,
+                                               flip_x=True)
         except pygame.error as e:
-            print(f"Error loading player image 'suzacque.png': {e}")
+            print(f"Error loading player image '{PLAYER_IMAGE}': {e}")
             sys.exit()
             
-        original_width = loaded_image.get_width()
-        original_height = loaded_image.get_height()
-        new_width = original_width // 10
-        new_height = original_height // 10
-        
-        if new_width < 1: new_width = 1
-        if new_height < 1: new_height = 1
-
-        scaled_image = pygame.transform.smoothscale(loaded_image, (new_width, new_height))
-        scaled_image.set_colorkey(CREAM) 
-        self.image_orig = scaled_image.convert_alpha()
-            
         self.image = self.image_orig
         self.width = self.image.get_width()
         self.height = self.image.get_height()
         self.rect = self.image.get_rect(topleft=(self.x, self.y))
+        # 羽根の形は120度ごとに同じになる
+        self.feathers = ParticleSystem(256, render_feather, gravity=0.3, spin=5,
+                                       rotation_period=120)
+        self.reset(x, y)
 
+    def reset(self, x, y):
+        self.x = x
+        self.y = y
+        self.rect.topleft = (x, y)
+        self.previous_topleft = self.rect.topleft
+        self.image = self.image_orig
         self.vel_x = 0
         self.vel_y = 0
         self.on_ground = False
@@ -81,14 +354,17 @@ class Player:
         self.jump_animation = 0
         self.wing_flap = 0
         self.hair_flow = 0
-        self.feathers = []
+        self.feathers.clear()
         
-    def update(self, platforms, enemies, coins):
-        keys = pygame.key.get_pressed()
-        if keys[pygame.K_LEFT]:
+    def remember(self):
+        # 描画の補間に使う、1ステップ前の位置
+        self.previous_topleft = self.rect.topleft
+
+    def update(self, inputs, grid, enemies, coins, world_width=SCREEN_WIDTH):
+        if inputs.left:
             self.vel_x = -5
             self.facing_right = False
-        elif keys[pygame.K_RIGHT]:
+        elif inputs.right:
             self.vel_x = 5
             self.facing_right = True
         else:
@@ -96,18 +372,13 @@ class Player:
             if abs(self.vel_x) < 0.1:
                 self.vel_x = 0
             
-        if keys[pygame.K_SPACE] and self.on_ground:
+        if inputs.jump and self.on_ground:
             self.vel_y = JUMP_STRENGTH
             self.jump_animation = 20
             for _ in range(5):
-                self.feathers.append({
-                    'x': self.rect.centerx,
-                    'y': self.rect.centery,
-                    'vel_x': random.uniform(-3, 3),
-                    'vel_y': random.uniform(-5, -2),
-                    'life': 30,
-                    'rotation': random.uniform(0, 360)
-                })
+                self.feathers.emit(self.rect.centerx, self.rect.centery,
+                                   self.rng.uniform(-3, 3), self.rng.uniform(-5, -2),
+                                   FEATHER_LIFE, self.rng.uniform(0, 360))
             
         self.vel_y += GRAVITY
         if self.vel_y > 20:
@@ -116,48 +387,50 @@ class Player:
         self.x += self.vel_x
         self.rect.x = int(self.x)
 
-        for platform in platforms:
-            if self.rect.colliderect(platform.rect):
-                if self.vel_x > 0:
-                    self.rect.right = platform.rect.left
-                elif self.vel_x < 0:
-                    self.rect.left = platform.rect.right
-                self.x = float(self.rect.x)
-                self.vel_x = 0
+        index = grid.next_collision(self.rect)
+        while index is not None:
+            platform = grid.platforms[index]
+            if self.vel_x > 0:
+                self.rect.right = platform.rect.left
+            elif self.vel_x < 0:
+                self.rect.left = platform.rect.right
+            self.x = float(self.rect.x)
+            self.vel_x = 0
+            index = grid.next_collision(self.rect, index)
 
         self.y += self.vel_y
         self.rect.y = int(self.y)
         
         self.on_ground = False
-        for platform in platforms:
-            if self.rect.colliderect(platform.rect):
-                if self.vel_y > 0:
-                    self.rect.bottom = platform.rect.top
-                    self.vel_y = 0
-                    self.on_ground = True
-                elif self.vel_y < 0:
-                    self.rect.top = platform.rect.bottom
-                    self.vel_y = 0
-                self.y = float(self.rect.y)
+        index = grid.next_collision(self.rect)
+        while index is not None:
+            platform = grid.platforms[index]
+            if self.vel_y > 0:
+                self.rect.bottom = platform.rect.top
+                self.vel_y = 0
+                self.on_ground = True
+            elif self.vel_y < 0:
+                self.rect.top = platform.rect.bottom
+                self.vel_y = 0
+            self.y = float(self.rect.y)
+            index = grid.next_collision(self.rect, index)
                     
-        for enemy in enemies[:]:
-            if self.rect.colliderect(enemy.rect):
-                if self.vel_y > 0 and self.rect.bottom < enemy.rect.centery:
-                    enemies.remove(enemy)
-                    self.vel_y = JUMP_STRENGTH / 2
-                    self.on_ground = False
-                else:
-                    return False
+        for enemy in enemies.overlapping(self.rect):
+            if self.vel_y > 0 and self.rect.bottom < enemies.rect(enemy).centery:
+                enemies.remove(enemy)
+                self.vel_y = JUMP_STRENGTH / 2
+                self.on_ground = False
+            else:
+                return False
                     
-        for coin in coins[:]:
-            if self.rect.colliderect(coin.rect):
-                coins.remove(coin)
+        for coin in coins.overlapping(self.rect):
+            coins.remove(coin)
                 
         if self.rect.left < 0:
             self.rect.left = 0
             self.x = float(self.rect.x)
-        if self.rect.right > SCREEN_WIDTH:
-            self.rect.right = SCREEN_WIDTH
+        if self.rect.right > world_width:
+            self.rect.right = world_width
             self.x = float(self.rect.x)
         
         self.animation_counter += 1
@@ -171,299 +444,911 @@ class Player:
             
         self.hair_flow = math.sin(self.animation_counter * 0.05) * 3
         
-        for feather in self.feathers[:]:
-            feather['x'] += feather['vel_x']
-            feather['y'] += feather['vel_y']
-            feather['vel_y'] += 0.3
-            feather['life'] -= 1
-            feather['rotation'] += 5
-            if feather['life'] <= 0:
-                self.feathers.remove(feather)
-
-        if self.facing_right:
-            self.image = self.image_orig
-        else:
-            self.image = pygame.transform.flip(self.image_orig, True, False)
+        self.feathers.step()
         
         return True
         
-    def draw(self, screen):
-        for feather in self.feathers:
-            alpha = feather['life'] / 30
-            size = int(10 * alpha)
-            if size > 0:
-                feather_color = (255, int(255 * alpha), int(255 * alpha))
-                points = []
-                for i in range(6):
-                    angle = (i * 60 + feather['rotation']) * math.pi / 180
-                    r = size if i % 2 == 0 else size // 2
-                    px = feather['x'] + r * math.cos(angle)
-                    py = feather['y'] + r * math.sin(angle)
-                    points.append((px, py))
-                if len(points) > 2:
-                    pygame.draw.polygon(screen, feather_color, points)
+    def draw(self, screen, offset=(0, 0), ground=None, alpha=1.0):
+        # alpha: 1ステップ前の位置(0)から今の位置(1)までのどこに描くか
+        self.image = self.image_orig if self.facing_right else self.image_flipped
+        ox, oy = offset
+        rect = self.rect
+        if alpha < 1:
+            px, py = self.previous_topleft
+            rect = rect.move(round((px - rect.x) * (1 - alpha)), round((py - rect.y) * (1 - alpha)))
+
+        dirty = rect.move(-ox, -oy)
+        for feather in self.feathers.draw(screen, offset):
+            dirty.union_ip(feather)
         
-        if self.on_ground:
+        # 影は真下の面に落とす。簡易な影は地上にいる時だけ足元に出す
+        shadow_quality = quality.tier.shadow
+        ground_top = None
+        if ground is not None and shadow_quality == SHADOW_SOFT:
+            ground_top = ground.surface_below(rect.centerx, rect.bottom - 5)
+        if shadow_quality == SHADOW_NONE or (shadow_quality == SHADOW_SIMPLE and not self.on_ground):
+            shadow_alpha = 0
+        elif self.on_ground:
             shadow_alpha = 150
             shadow_width_ratio = 0.8
             shadow_height_ratio = 0.2
         else:
-            dist_to_ground_approx = SCREEN_HEIGHT - self.rect.bottom
-            if dist_to_ground_approx < 0: dist_to_ground_approx = 0
+            # 真下に何も無ければレベルの底までの高さ
+            floor = ground.floor if ground is not None else SCREEN_HEIGHT
+            dist_to_ground = (floor if ground_top is None else ground_top) - rect.bottom
+            if dist_to_ground < 0: dist_to_ground = 0
             max_dist_for_shadow = 300
-            if dist_to_ground_approx > max_dist_for_shadow:
+            if dist_to_ground > max_dist_for_shadow:
                 shadow_alpha = 0
             else:
-                shadow_alpha = int(100 * (1 - dist_to_ground_approx / max_dist_for_shadow))
-            shadow_width_ratio = 0.6 * (1 - dist_to_ground_approx / (max_dist_for_shadow * 2))
-            shadow_height_ratio = 0.15 * (1 - dist_to_ground_approx / (max_dist_for_shadow * 2))
+                shadow_alpha = int(100 * (1 - dist_to_ground / max_dist_for_shadow))
+            shadow_width_ratio = 0.6 * (1 - dist_to_ground / (max_dist_for_shadow * 2))
+            shadow_height_ratio = 0.15 * (1 - dist_to_ground / (max_dist_for_shadow * 2))
             if shadow_width_ratio < 0.1 : shadow_width_ratio = 0.1
             if shadow_height_ratio < 0.05 : shadow_height_ratio = 0.05
 
+        shadow_surface = None
         if shadow_alpha > 0:
-            shadow_surface = pygame.Surface((int(self.width * shadow_width_ratio), int(self.height * shadow_height_ratio)), pygame.SRCALPHA)
-            shadow_surface.fill((0,0,0,0))
-            pygame.draw.ellipse(shadow_surface, (0, 0, 0, shadow_alpha), shadow_surface.get_rect())
-            shadow_pos_x = self.rect.centerx - shadow_surface.get_width() // 2
-            shadow_y = self.rect.bottom + 2
-            closest_platform_top = SCREEN_HEIGHT
-            found_platform_below = False
-            for p in current_platforms_for_shadow:
-                if p.rect.left < self.rect.centerx < p.rect.right and p.rect.top >= self.rect.bottom -5:
-                    if p.rect.top < closest_platform_top:
-                        closest_platform_top = p.rect.top
-                        found_platform_below = True
-            if found_platform_below:
-                 shadow_y = closest_platform_top - shadow_surface.get_height() // 2 + 2
+            shadow_surface = resources.shadow(int(self.width * shadow_width_ratio), int(self.height * shadow_height_ratio), shadow_alpha)
+        if shadow_surface is not None:
+            shadow_pos_x = rect.centerx - shadow_surface.get_width() // 2
+            if ground_top is not None:
+                 shadow_y = ground_top - shadow_surface.get_height() // 2 + 2
             else:
-                shadow_y = self.rect.bottom + 5 - shadow_surface.get_height() // 2
-            screen.blit(shadow_surface, (shadow_pos_x, shadow_y))
+                shadow_y = rect.bottom + 5 - shadow_surface.get_height() // 2
+            dirty.union_ip(screen.blit(shadow_surface, (shadow_pos_x - ox, shadow_y - oy)))
         
-        screen.blit(self.image, self.rect)
+        screen.blit(self.image, (rect.x - ox, rect.y - oy))
+        return dirty
+
+# 足場の見た目キャッシュ
+# 種類とサイズが同じ足場は一枚の焼き込み済みサーフェスを共有する。
+# 草の揺れは周期的なので、一周分をコマ送りのストリップとして焼いておく。
+GRASS_SWAY_PERIOD = 2 * math.pi / 0.05
+GRASS_SWAY_FRAMES = 32
+GRASS_STRIP_HEIGHT = 11
+ART_COLORKEY = (255, 0, 255)
+# 長い足場はこの幅の絵を横に並べて描き、右端だけ残りの幅の絵にする。
+# 地面の幅は草の間隔15の倍数で、揺れの位相 (0.05/px) がほぼ一周する (2010 * 0.05 ≈ 32π) ので
+# 継ぎ目が見えない。レンガは模様の周期40の倍数。
+PLATFORM_TILE_WIDTHS = {"ground": 2010, "brick": 2000}
+
+def _keyed_surface(size):
+    surface = pygame.Surface(size)
+    surface.fill(ART_COLORKEY)
+    surface.set_colorkey(ART_COLORKEY, pygame.RLEACCEL)
+    return surface
+
+def paint_ground_body(surface, rect):
+    pygame.draw.rect(surface, DARK_GREEN, rect)
+    pygame.draw.rect(surface, GREEN, (rect.x, rect.y, rect.width, 10))
+
+def paint_ground_grass(surface, rect, animation_counter):
+    for i in range(0, rect.width, 15):
+        grass_height = 8 + math.sin((animation_counter + i) * 0.05) * 2
+        pygame.draw.polygon(surface, (0, 200, 0), [
+            (rect.x + i, rect.y + 10),
+            (rect.x + i + 3, rect.y + 10 - grass_height),
+            (rect.x + i + 6, rect.y + 10)
+        ])
+        pygame.draw.polygon(surface, (0, 150, 0), [
+            (rect.x + i + 7, rect.y + 10),
+            (rect.x + i + 10, rect.y + 10 - grass_height + 2),
+            (rect.x + i + 13, rect.y + 10)
+        ])
+
+def paint_brick(surface, rect):
+    pygame.draw.rect(surface, BRICK_RED, rect)
+    pygame.draw.rect(surface, (200, 60, 60), 
+                   (rect.x, rect.y, rect.width, 4))
+    pygame.draw.rect(surface, (120, 20, 20), 
+                   (rect.x, rect.bottom - 4, rect.width, 4))
+    for i in range(0, rect.width, 20):
+        for j in range(0, rect.height, 15):
+            pygame.draw.rect(surface, (100, 20, 20), 
+                           (rect.x + i, rect.y + j, 19, 14), 1)
+            if (i + j) % 40 < 20:
+                pygame.draw.rect(surface, (160, 40, 40), 
+                               (rect.x + i + 2, rect.y + j + 2, 15, 10))
+
+def paint_pipe(surface, rect, lip):
+    pygame.draw.rect(surface, GREEN, rect)
+    highlight_x = rect.x + 5
+    pygame.draw.rect(surface, (100, 255, 100), 
+                   (highlight_x, rect.y, 8, rect.height))
+    pygame.draw.rect(surface, (150, 255, 150), 
+                   (highlight_x + 2, rect.y, 4, rect.height))
+    pygame.draw.rect(surface, DARK_GREEN,
+                   (rect.right - 10, rect.y, 10, rect.height))
+    if lip:
+        pygame.draw.rect(surface, GREEN, 
+                       (rect.x - 5, rect.y - 10, rect.width + 10, 15))
+        pygame.draw.rect(surface, DARK_GREEN,
+                       (rect.x - 5, rect.y - 10, rect.width + 10, 15), 3)
+        pygame.draw.rect(surface, (100, 255, 100), 
+                       (rect.x - 3, rect.y - 8, 10, 11))
+
+class PlatformArt:
+    cache = {}
+
+    @classmethod
+    def get(cls, platform_type, width, height, lip=False):
+        key = (platform_type, width, height, lip)
+        art = cls.cache.get(key)
+        if art is None:
+            art = cls(platform_type, width, height, lip)
+            cls.cache[key] = art
+        return art
+
+    def __init__(self, platform_type, width, height, lip=False):
+        self.type = platform_type
+        # 描画が矩形からはみ出す分（土管のふち、草やレンガの端）を含めた範囲
+        left, top, right, bottom = 0, 0, width, height
+        if platform_type == "ground":
+            right = max(right, (width - 1) // 15 * 15 + 14)
+        elif platform_type == "brick":
+            right = max(right, (width - 1) // 20 * 20 + 19)
+            bottom = max(bottom, (height - 1) // 15 * 15 + 14)
+        elif platform_type == "pipe" and lip:
+            left, top, right = -5, -10, width + 5
+        self.offset = (left, top)
+        self.size = (right - left, bottom - top)
+        rect = pygame.Rect(-left, -top, width, height)
+
+        self.surface = _keyed_surface(self.size)
+        self.frames = []
+        if platform_type == "ground":
+            paint_ground_body(self.surface, rect)
+            for k in range(GRASS_SWAY_FRAMES):
+                frame = _keyed_surface((self.size[0], GRASS_STRIP_HEIGHT))
+                paint_ground_body(frame, rect)
+                paint_ground_grass(frame, rect, k * GRASS_SWAY_PERIOD / GRASS_SWAY_FRAMES)
+                self.frames.append(_to_display_format(frame))
+        elif platform_type == "brick":
+            paint_brick(self.surface, rect)
+        elif platform_type == "pipe":
+            paint_pipe(self.surface, rect, lip)
+        self.surface = _to_display_format(self.surface)
+
+    @staticmethod
+    def frame_index(animation_counter):
+        # 今の段階で描く草の揺れのコマ
+        if not quality.tier.grass:
+            return 0
+        return int(round(animation_counter * GRASS_SWAY_FRAMES / GRASS_SWAY_PERIOD)) % GRASS_SWAY_FRAMES
+
+    def draw(self, screen, x, y, animation_counter=0, backdrop=None):
+        # backdrop を渡すと草の帯だけを、その下の背景を backdrop から戻してから描く
+        pos = (x + self.offset[0], y + self.offset[1])
+        if self.frames and backdrop is not None:
+            rect = pygame.Rect(pos, (self.size[0], GRASS_STRIP_HEIGHT))
+            screen.blit(backdrop, rect, rect)
+            screen.blit(self.frames[self.frame_index(animation_counter)], pos)
+            return rect
+        if self.frames:
+            strip = GRASS_STRIP_HEIGHT
+            screen.blit(self.surface, (pos[0], pos[1] + strip),
+                        (0, strip, self.size[0], self.size[1] - strip))
+            screen.blit(self.frames[self.frame_index(animation_counter)], pos)
+        else:
+            screen.blit(self.surface, pos)
+        return pygame.Rect(pos, self.size)
 
 class Platform:
     def __init__(self, x, y, width, height, platform_type="ground"):
         self.rect = pygame.Rect(x, y, width, height)
         self.type = platform_type
-        self.animation_counter = 0
-        
-    def draw(self, screen):
-        self.animation_counter += 1
-        
-        if self.type == "ground":
-            pygame.draw.rect(screen, DARK_GREEN, self.rect)
-            pygame.draw.rect(screen, GREEN, (self.rect.x, self.rect.y, self.rect.width, 10))
-            
-            for i in range(0, self.rect.width, 15):
-                grass_height = 8 + math.sin((self.animation_counter + i) * 0.05) * 2
-                pygame.draw.polygon(screen, (0, 200, 0), [
-                    (self.rect.x + i, self.rect.y + 10),
-                    (self.rect.x + i + 3, self.rect.y + 10 - grass_height),
-                    (self.rect.x + i + 6, self.rect.y + 10)
-                ])
-                pygame.draw.polygon(screen, (0, 150, 0), [
-                    (self.rect.x + i + 7, self.rect.y + 10),
-                    (self.rect.x + i + 10, self.rect.y + 10 - grass_height + 2),
-                    (self.rect.x + i + 13, self.rect.y + 10)
-                ])
-                
-        elif self.type == "brick":
-            pygame.draw.rect(screen, BRICK_RED, self.rect)
-            pygame.draw.rect(screen, (200, 60, 60), 
-                           (self.rect.x, self.rect.y, self.rect.width, 4))
-            pygame.draw.rect(screen, (120, 20, 20), 
-                           (self.rect.x, self.rect.bottom - 4, self.rect.width, 4))
-            for i in range(0, self.rect.width, 20):
-                for j in range(0, self.rect.height, 15):
-                    pygame.draw.rect(screen, (100, 20, 20), 
-                                   (self.rect.x + i, self.rect.y + j, 19, 14), 1)
-                    if (i + j) % 40 < 20:
-                        pygame.draw.rect(screen, (160, 40, 40), 
-                                       (self.rect.x + i + 2, self.rect.y + j + 2, 15, 10))
-                                       
-        elif self.type == "pipe":
-            pygame.draw.rect(screen, GREEN, self.rect)
-            highlight_x = self.rect.x + 5
-            pygame.draw.rect(screen, (100, 255, 100), 
-                           (highlight_x, self.rect.y, 8, self.rect.height))
-            pygame.draw.rect(screen, (150, 255, 150), 
-                           (highlight_x + 2, self.rect.y, 4, self.rect.height))
-            pygame.draw.rect(screen, DARK_GREEN,
-                           (self.rect.right - 10, self.rect.y, 10, self.rect.height))
-            if self.rect.y > 100:
-                pygame.draw.rect(screen, GREEN, 
-                               (self.rect.x - 5, self.rect.y - 10, self.rect.width + 10, 15))
-                pygame.draw.rect(screen, DARK_GREEN,
-                               (self.rect.x - 5, self.rect.y - 10, self.rect.width + 10, 15), 3)
-                pygame.draw.rect(screen, (100, 255, 100), 
-                               (self.rect.x - 3, self.rect.y - 8, 10, 11))
-
-class Enemy:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        self.width = 35
-        self.height = 35
-        self.vel_x = 2
-        self.rect = pygame.Rect(x, y, self.width, self.height)
-        self.animation_counter = 0
-        self.squash = 0
-        
-    def update(self, platforms):
-        self.x += self.vel_x
-        self.rect.x = int(self.x)
-        
-        on_platform_edge = False
-        for platform in platforms:
-            foot_check_rect = pygame.Rect(self.rect.left, self.rect.bottom, self.width, 5)
-            next_foot_check_rect = pygame.Rect(self.rect.left + self.vel_x, self.rect.bottom, self.width, 5)
-            if foot_check_rect.colliderect(platform.rect):
-                if not next_foot_check_rect.colliderect(platform.rect):
-                    if (self.vel_x > 0 and self.rect.right >= platform.rect.right - abs(self.vel_x)) or \
-                       (self.vel_x < 0 and self.rect.left <= platform.rect.left + abs(self.vel_x)):
-                        on_platform_edge = True
-                        break
-        if on_platform_edge:
-            self.vel_x *= -1
-
-        if self.rect.left <= 0 :
-            self.rect.left = 0
-            self.vel_x *= -1
-            self.x = float(self.rect.x)
-        elif self.rect.right >= SCREEN_WIDTH:
-            self.rect.right = SCREEN_WIDTH
-            self.vel_x *= -1
-            self.x = float(self.rect.x)
 
-        self.animation_counter += 1
-        self.squash = math.sin(self.animation_counter * 0.2) * 3
-            
-    def draw(self, screen):
-        cx = self.rect.centerx
-        cy = self.rect.centery
-        pygame.draw.ellipse(screen, (100, 100, 100), 
-                          (self.rect.x + 2, self.rect.y + self.height - 5, self.width - 4, 8))
-        body_height = self.height - 5 + self.squash
-        pygame.draw.ellipse(screen, BROWN, 
-                          (self.rect.x, self.rect.y + 5 - self.squash, self.width, body_height))
-        pygame.draw.ellipse(screen, (160, 82, 45), 
-                          (self.rect.x + 3, self.rect.y + 7 - self.squash, self.width - 6, 15))
-        face_y = cy - 5 + self.squash // 2
-        pygame.draw.ellipse(screen, BLACK, (cx - 10, face_y - 3, 6, 8))
-        pygame.draw.ellipse(screen, WHITE, (cx - 9, face_y - 2, 2, 2))
-        pygame.draw.ellipse(screen, BLACK, (cx + 4, face_y - 3, 6, 8))
-        pygame.draw.ellipse(screen, WHITE, (cx + 5, face_y - 2, 2, 2))
-        pygame.draw.line(screen, BLACK, (cx - 12, face_y - 6), (cx - 7, face_y - 4), 3)
-        pygame.draw.line(screen, BLACK, (cx + 12, face_y - 6), (cx + 7, face_y - 4), 3)
-        pygame.draw.arc(screen, BLACK, (cx - 8, face_y + 2, 16, 8), 0.3, 2.8, 2)
-        pygame.draw.polygon(screen, WHITE, [
-            (cx - 5, face_y + 4), (cx - 3, face_y + 7), (cx - 1, face_y + 4)])
-        pygame.draw.polygon(screen, WHITE, [
-            (cx + 1, face_y + 4), (cx + 3, face_y + 7), (cx + 5, face_y + 4)])
-        foot_offset = math.sin(self.animation_counter * 0.3) * 3
-        pygame.draw.ellipse(screen, (80, 40, 0), 
-                          (self.rect.x + 5 + foot_offset, self.rect.y + self.height - 10, 12, 10))
-        pygame.draw.ellipse(screen, BLACK, 
-                          (self.rect.x + 7 + foot_offset, self.rect.y + self.height - 8, 8, 6))
-        pygame.draw.ellipse(screen, (80, 40, 0), 
-                          (self.rect.x + 18 - foot_offset, self.rect.y + self.height - 10, 12, 10))
-        pygame.draw.ellipse(screen, BLACK, 
-                          (self.rect.x + 20 - foot_offset, self.rect.y + self.height - 8, 8, 6))
-
-class Coin:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        self.rect = pygame.Rect(x, y, 30, 30)
-        self.animation_counter = 0
-        self.sparkles = []
-        
-    def draw(self, screen):
-        self.animation_counter += 1
-        width = abs(30 * math.cos(self.animation_counter * 0.05))
-        cx = self.rect.centerx
-        cy = self.rect.centery
-        if self.animation_counter % 10 == 0:
-            angle = random.uniform(0, 2 * math.pi)
-            dist = random.uniform(15, 25)
-            self.sparkles.append({
-                'x': cx + math.cos(angle) * dist,
-                'y': cy + math.sin(angle) * dist,
-                'life': 20
-            })
-        for sparkle in self.sparkles[:]:
-            sparkle['life'] -= 1
-            if sparkle['life'] <= 0:
-                self.sparkles.remove(sparkle)
-            else:
-                size = sparkle['life'] // 5
-                if size > 0:
-                    pygame.draw.circle(screen, YELLOW, 
-                                     (int(sparkle['x']), int(sparkle['y'])), size)
-        if width > 2:
-            pygame.draw.ellipse(screen, GOLD, 
-                              (cx - width/2, cy - 15, width, 30))
-            pygame.draw.ellipse(screen, YELLOW, 
-                              (cx - width/2 + 2, cy - 13, width - 4, 26))
-            if width > 20:
-                star_points = []
-                for i in range(10):
-                    angle = i * math.pi / 5
-                    r = 8 if i % 2 == 0 else 4
-                    px = cx + r * math.cos(angle - math.pi / 2)
-                    py = cy + r * math.sin(angle - math.pi / 2)
-                    star_points.append((px, py))
-                pygame.draw.polygon(screen, GOLD, star_points)
-            if width > 15:
-                pygame.draw.ellipse(screen, WHITE, 
-                                  (cx - width/4, cy - 8, width/2, 8))
-
-def draw_background(screen):
-    for i in range(SCREEN_HEIGHT // 2):
-        progress = i / (SCREEN_HEIGHT // 2)
-        r = int(LIGHT_SKY_BLUE_GRADIENT_TOP[0] * (1 - progress) + SKY_BLUE[0] * progress)
-        g = int(LIGHT_SKY_BLUE_GRADIENT_TOP[1] * (1 - progress) + SKY_BLUE[1] * progress)
-        b = int(LIGHT_SKY_BLUE_GRADIENT_TOP[2] * (1 - progress) + SKY_BLUE[2] * progress)
-        color = (max(0, min(r, 255)), max(0, min(g, 255)), max(0, min(b, 255)))
-        pygame.draw.line(screen, color, (0, i), (SCREEN_WIDTH, i))
-    
-    pygame.draw.rect(screen, SKY_BLUE, (0, SCREEN_HEIGHT // 2, SCREEN_WIDTH, SCREEN_HEIGHT // 2))
+    def _art(self, width):
+        lip = self.type == "pipe" and self.rect.y > 100
+        return PlatformArt.get(self.type, width, self.rect.height, lip)
+
+    @property
+    def tile_width(self):
+        tile = PLATFORM_TILE_WIDTHS.get(self.type, 0)
+        return tile if self.rect.width > tile else 0
+
+    @property
+    def art(self):
+        # 並べて描く足場では右端の1枚の絵
+        width = self.rect.width
+        tile = self.tile_width
+        if tile:
+            width -= (width - 1) // tile * tile
+        return self._art(width)
+
+    def bake(self):
+        # 描くのに使う絵を全て先に作っておく
+        tile = self.tile_width
+        return (self._art(tile), self.art) if tile else (self.art,)
+
+    def draw_art(self, screen, x, y, animation_counter=0, backdrop=None):
+        tile = self.tile_width
+        if not tile:
+            return self.art.draw(screen, x, y, animation_counter, backdrop)
+        # 画面に掛かる枚数だけ描く
+        last = (self.rect.width - 1) // tile
+        first = max(0, -x // tile)
+        stop = min(last, (screen.get_width() - 1 - x) // tile)
+        rect = pygame.Rect(x + first * tile, y, 0, 0)
+        for k in range(first, stop + 1):
+            art = self.art if k == last else self._art(tile)
+            rect.union_ip(art.draw(screen, x + k * tile, y, animation_counter, backdrop))
+        return rect
 
+    def draw(self, screen, offset=(0, 0), frame=0, backdrop=None):
+        # 草の揺れはコインと同じくステップ数で進めるので、描画の頻度で速さが変わらない
+        return self.draw_art(screen, self.rect.x - offset[0], self.rect.y - offset[1], frame, backdrop)
+
+# 足場の空間ハッシュ
+# 静的な足場の矩形を一様グリッドに登録しておき、動く矩形の近くにある足場だけを調べる。
+# 足場はキー（レベル内の通し番号）の順に衝突を解決する。
+# チャンクの読み込み・破棄に合わせて足場を追加・削除できる。
+class PlatformGrid:
+    def __init__(self, platforms=(), cell_size=128):
+        self.platforms = {}
+        self.cell_size = cell_size
+        self.cells = {}
+        for index, platform in enumerate(platforms):
+            self.add(index, platform)
+
+    def __len__(self):
+        return len(self.platforms)
+
+    def add(self, key, platform):
+        self.platforms[key] = platform
+        for cell in self._cells(platform.rect):
+            insort(self.cells.setdefault(cell, []), key)
+
+    def remove(self, key):
+        platform = self.platforms.pop(key)
+        for cell in self._cells(platform.rect):
+            keys = self.cells[cell]
+            keys.remove(key)
+            if not keys:
+                del self.cells[cell]
+
+    def _cells(self, rect):
+        size = self.cell_size
+        for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                yield (cx, cy)
+
+    def next_collision(self, rect, after=-1):
+        # afterより後ろで、今のrectと重なる最初の足場のキーを返す。
+        # 全足場を順番に調べるループと同じ順序で衝突を解決するために使う。
+        best = None
+        for cell in self._cells(rect):
+            for key in self.cells.get(cell, ()):
+                if best is not None and key >= best:
+                    break
+                if key > after and rect.colliderect(self.platforms[key].rect):
+                    best = key
+        return best
+
+# 地面の索引
+# 「点 (x, y) の真下で一番高い足場の上端」を二分探索2回で答える。
+# 足場の左右の端でx軸を区間に区切ると、各区間の上にある足場の組は区間の中で変わらないので、
+# 区間ごとに上端を並べておけばよい。表は (区間番号 << 32) + 上端 の整列済み配列一本にまとめる。
+# 足場がxの上にあるのは left < x < right の時（端ちょうどは含まない）。
+# 足場が入れ替わった後、最初の問い合わせで作り直す。
+GROUND_KEY_SHIFT = 32
+GROUND_KEY_BIAS = 1 << 31
+
+class GroundIndex:
+    def __init__(self, platforms=(), floor=SCREEN_HEIGHT):
+        # floor: 下に何も無い時の地面（レベルの底）
+        self.floor = floor
+        self.platforms = list(platforms)
+        self.dirty = True
+        self.breaks = np.zeros(0, dtype=np.int64)
+        self.keys = np.zeros(0, dtype=np.int64)
+
+    def set_platforms(self, platforms):
+        self.platforms = platforms
+        self.dirty = True
+
+    def _build(self):
+        rects = [platform.rect for platform in self.platforms]
+        # 足場が上にある整数のxは [left + 1, right)
+        starts = np.array([rect.left + 1 for rect in rects], dtype=np.int64)
+        ends = np.array([rect.right for rect in rects], dtype=np.int64)
+        tops = np.array([rect.top for rect in rects], dtype=np.int64)
+        covers = ends > starts
+        starts, ends, tops = starts[covers], ends[covers], tops[covers]
+        self.breaks = np.unique(np.concatenate((starts, ends)))
+        first = np.searchsorted(self.breaks, starts)
+        counts = np.searchsorted(self.breaks, ends) - first
+        # 足場ごとに、覆う区間の番号 first, first + 1, ..., first + count - 1 を並べる
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        intervals = np.repeat(first, counts) + within
+        self.keys = np.sort((intervals << GROUND_KEY_SHIFT) + np.repeat(tops, counts) + GROUND_KEY_BIAS)
+        # 問い合わせは1点ずつなので、NumPyよりリストの二分探索の方が速い
+        self.break_list = self.breaks.tolist()
+        self.key_list = self.keys.tolist()
+        self.dirty = False
+
+    def surface_below(self, x, y):
+        # 真下の面の上端。何も無ければ None
+        if self.dirty:
+            self._build()
+        interval = bisect_right(self.break_list, x) - 1
+        if interval < 0:
+            return None
+        keys = self.key_list
+        found = bisect_left(keys, (interval << GROUND_KEY_SHIFT) + y + GROUND_KEY_BIAS)
+        if found < len(keys) and keys[found] >> GROUND_KEY_SHIFT == interval:
+            return (keys[found] & 0xFFFFFFFF) - GROUND_KEY_BIAS
+        return None
+
+# エンティティストア
+# 同じ種類のエンティティの部品を列ごとのNumPy配列に密に詰めて持つ。
+# 外からはハンドル（世代 << 32 | スロット）で指すので、削除で最後の行を空いた所へ
+# 移しても（swap-remove）ハンドルは変わらず、削除済みのハンドルは世代の違いで見分けられる。
+# 行の順番は削除で入れ替わるので、順番が結果に効く所は level_id で並べ直す。
+# 行が少ない時（チャンク読み込みで普段はこちら）はNumPyの呼び出しの固定費の方が高くつくので、
+# SCALAR_ROW_LIMIT 未満ならPythonのループで同じ結果を出す。
+HANDLE_SLOT_BITS = 32
+HANDLE_SLOT_MASK = (1 << HANDLE_SLOT_BITS) - 1
+SCALAR_ROW_LIMIT = 32
+
+class EntityStore:
+    # (名前, dtype) の組。left, top, level_id は全ての種類が持つ
+    columns = (("left", np.int64), ("top", np.int64), ("level_id", np.int64))
+    width = 0
+    height = 0
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.capacity = 0
+        self.arrays = ()
+        self.generations = []
+        self.slot_rows = []
+        self.free_slots = []
+        self.row_slots = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        old = self.arrays
+        self.capacity = capacity
+        self.arrays = tuple(np.zeros(capacity, dtype=dtype) for _, dtype in self.columns)
+        for (name, _), array, previous in zip(self.columns, self.arrays, old or (None,) * len(self.columns)):
+            if previous is not None:
+                array[:self.count] = previous[:self.count]
+            setattr(self, name, array)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.handles())
+
+    def handle(self, row):
+        slot = self.row_slots[row]
+        return self.generations[slot] << HANDLE_SLOT_BITS | slot
+
+    def handles(self, rows=None):
+        rows = range(self.count) if rows is None else rows.tolist()
+        return [self.handle(row) for row in rows]
+
+    def row(self, handle):
+        # 削除済みのハンドルには -1 を返す
+        slot = handle & HANDLE_SLOT_MASK
+        if slot < len(self.generations) and self.generations[slot] == handle >> HANDLE_SLOT_BITS:
+            return self.slot_rows[slot]
+        return -1
+
+    def create(self, left, top, level_id=0):
+        if self.count == self.capacity:
+            self._allocate(self.capacity * 2)
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            slot = len(self.generations)
+            self.generations.append(0)
+            self.slot_rows.append(-1)
+        row = self.count
+        self.count += 1
+        self.slot_rows[slot] = row
+        self.row_slots.append(slot)
+        self.left[row] = left
+        self.top[row] = top
+        self.level_id[row] = level_id
+        return self.generations[slot] << HANDLE_SLOT_BITS | slot
+
+    def remove(self, handle):
+        row = self.row(handle)
+        if row < 0:
+            return False
+        last = self.count - 1
+        slot = handle & HANDLE_SLOT_MASK
+        if row != last:
+            for array in self.arrays:
+                array[row] = array[last]
+            moved = self.row_slots[last]
+            self.row_slots[row] = moved
+            self.slot_rows[moved] = row
+        self.row_slots.pop()
+        self.count = last
+        self.generations[slot] += 1
+        self.slot_rows[slot] = -1
+        self.free_slots.append(slot)
+        return True
+
+    def clear(self):
+        for slot in self.row_slots:
+            self.generations[slot] += 1
+            self.slot_rows[slot] = -1
+            self.free_slots.append(slot)
+        self.row_slots = []
+        self.count = 0
+
+    def _row_list_overlapping(self, rect):
+        n = self.count
+        right = rect.right
+        bottom = rect.bottom
+        min_left = rect.left - self.width
+        min_top = rect.top - self.height
+        return [row for row, (left, top) in enumerate(zip(self.left[:n].tolist(), self.top[:n].tolist()))
+                if min_left < left < right and min_top < top < bottom]
+
+    def rows_overlapping(self, rect):
+        n = self.count
+        if n < SCALAR_ROW_LIMIT:
+            return np.array(self._row_list_overlapping(rect), dtype=np.intp)
+        left = self.left[:n]
+        top = self.top[:n]
+        return ((left < rect.right) & (left > rect.left - self.width) &
+                (top < rect.bottom) & (top > rect.top - self.height)).nonzero()[0]
+
+    def in_level_order(self, rows):
+        return rows[np.argsort(self.level_id[rows], kind="stable")]
+
+    def overlapping(self, rect):
+        # rectと重なるエンティティのハンドルを level_id 順に返す
+        if not self.count:
+            return []
+        if self.count < SCALAR_ROW_LIMIT:
+            rows = self._row_list_overlapping(rect)
+            if len(rows) > 1:
+                rows.sort(key=self.level_id[:self.count].tolist().__getitem__)
+            return [self.handle(row) for row in rows]
+        return self.handles(self.in_level_order(self.rows_overlapping(rect)))
+
+    def rect(self, handle):
+        row = self.row(handle)
+        return pygame.Rect(int(self.left[row]), int(self.top[row]), self.width, self.height)
+
+# 敵のアニメーションアトラス
+# 敵の形はsquashとfoot_offsetだけで決まるので、両方を量子化した全コマを
+# 焼いておき、全ての敵で共有する。RLEのサーフェスを範囲指定で描くと毎回先頭から
+# 展開し直すので、コマごとに小さなサーフェスに分けておく。
+ENEMY_WIDTH = 35
+ENEMY_HEIGHT = 35
+ENEMY_ATLAS_MARGIN = 2
+ENEMY_ANIMATION_STEP = 0.5
+ENEMY_ANIMATION_RANGE = 3
+
+def paint_enemy(surface, x, y, width, height, squash, foot_offset):
+    cx = x + width // 2
+    cy = y + height // 2
+    pygame.draw.ellipse(surface, (100, 100, 100), 
+                      (x + 2, y + height - 5, width - 4, 8))
+    body_height = height - 5 + squash
+    pygame.draw.ellipse(surface, BROWN, 
+                      (x, y + 5 - squash, width, body_height))
+    pygame.draw.ellipse(surface, (160, 82, 45), 
+                      (x + 3, y + 7 - squash, width - 6, 15))
+    face_y = cy - 5 + squash // 2
+    pygame.draw.ellipse(surface, BLACK, (cx - 10, face_y - 3, 6, 8))
+    pygame.draw.ellipse(surface, WHITE, (cx - 9, face_y - 2, 2, 2))
+    pygame.draw.ellipse(surface, BLACK, (cx + 4, face_y - 3, 6, 8))
+    pygame.draw.ellipse(surface, WHITE, (cx + 5, face_y - 2, 2, 2))
+    pygame.draw.line(surface, BLACK, (cx - 12, face_y - 6), (cx - 7, face_y - 4), 3)
+    pygame.draw.line(surface, BLACK, (cx + 12, face_y - 6), (cx + 7, face_y - 4), 3)
+    pygame.draw.arc(surface, BLACK, (cx - 8, face_y + 2, 16, 8), 0.3, 2.8, 2)
+    pygame.draw.polygon(surface, WHITE, [
+        (cx - 5, face_y + 4), (cx - 3, face_y + 7), (cx - 1, face_y + 4)])
+    pygame.draw.polygon(surface, WHITE, [
+        (cx + 1, face_y + 4), (cx + 3, face_y + 7), (cx + 5, face_y + 4)])
+    pygame.draw.ellipse(surface, (80, 40, 0), 
+                      (x + 5 + foot_offset, y + height - 10, 12, 10))
+    pygame.draw.ellipse(surface, BLACK, 
+                      (x + 7 + foot_offset, y + height - 8, 8, 6))
+    pygame.draw.ellipse(surface, (80, 40, 0), 
+                      (x + 18 - foot_offset, y + height - 10, 12, 10))
+    pygame.draw.ellipse(surface, BLACK, 
+                      (x + 20 - foot_offset, y + height - 8, 8, 6))
+
+class EnemyAtlas:
+    def __init__(self, width=ENEMY_WIDTH, height=ENEMY_HEIGHT):
+        self.width = width
+        self.height = height
+        self.levels = int(ENEMY_ANIMATION_RANGE * 2 / ENEMY_ANIMATION_STEP) + 1
+        self.frame_size = (width + ENEMY_ATLAS_MARGIN * 2, height + 3 + ENEMY_ATLAS_MARGIN * 2)
+        self.frames = []
+
+    def index(self, value):
+        return int(round((value + ENEMY_ANIMATION_RANGE) / ENEMY_ANIMATION_STEP))
+
+    def build(self):
+        frames = []
+        for i in range(self.levels):
+            squash = i * ENEMY_ANIMATION_STEP - ENEMY_ANIMATION_RANGE
+            for j in range(self.levels):
+                foot_offset = j * ENEMY_ANIMATION_STEP - ENEMY_ANIMATION_RANGE
+                frame = _keyed_surface(self.frame_size)
+                paint_enemy(frame, ENEMY_ATLAS_MARGIN, ENEMY_ATLAS_MARGIN,
+                            self.width, self.height, squash, foot_offset)
+                frames.append(_to_display_format(frame))
+        self.frames = frames
+
+    def draw(self, screen, x, y, squash, foot_offset):
+        if not self.frames:
+            self.build()
+        frame = self.frames[self.index(squash) * self.levels + self.index(foot_offset)]
+        return screen.blit(frame, (x - ENEMY_ATLAS_MARGIN, y - ENEMY_ATLAS_MARGIN))
+
+enemy_atlas = EnemyAtlas()
+
+ENEMY_SPEED = 2
+ENEMY_FOOT_DEPTH = 5
+# 端の表は (高さのグループ << 33) + (右端なら1 << 32) + 座標 で一本の整列済み配列にする
+EDGE_KEY_GROUP_SHIFT = 33
+EDGE_KEY_RIGHT = 1 << 32
+EDGE_KEY_BIAS = 1 << 31
+NO_EDGE_AHEAD = 1 << 62
+NO_EDGE_BEHIND = -(1 << 62)
+
+# 敵の一括更新
+# 全ての敵の位置・速度・アニメーションをNumPy配列に持ち、移動・足場の端での折り返し・
+# 壁での跳ね返りを配列演算でまとめて行う。結果は1体ずつ処理していた時と同じになる。
+# 敵は上下に動かないので、足元の帯 (bottom, bottom + 5) に重なる足場は敵の高さごとに決まる。
+# 高さごとに足場の左端と右端を並べた表を作っておくと、元の3つの条件は次と同じになる
+# （速さが敵の幅より小さい時）:
+#   右向き  rx < 足場の右端 <= 次のrx                    の足場があれば折り返す
+#   左向き  次のrx + w - 1 < 足場の左端 <= rx + w - 1    の足場があれば折り返す
+# 毎フレーム調べる範囲は途切れずにつながっているので、折り返すまでは進む先で最初に出会う
+# 端は変わらない。向きが変わった敵だけ表を二分探索してその端（limit）を覚えておき、
+# 毎フレームは比較するだけにする。
+class EnemyStore(EntityStore):
+    columns = EntityStore.columns + (("x", np.float64), ("vel_x", np.float64),
+                                     ("animation_counter", np.int64), ("group_key", np.int64),
+                                     ("limit", np.int64), ("previous_left", np.int64))
+    width = ENEMY_WIDTH
+    height = ENEMY_HEIGHT
+
+    def __init__(self, capacity=64):
+        super().__init__(capacity)
+        self.platforms = []
+        self.platforms_dirty = True
+        self.groups_dirty = True
+        self.limits_dirty = True
+        self.group_bottoms = np.zeros(0, dtype=np.int64)
+        self.edges = np.zeros(0, dtype=np.int64)
+
+    def spawn(self, x, y, level_id=0):
+        # 出現位置から右向きに動き始める
+        handle = self.create(x, y, level_id)
+        row = self.count - 1
+        self.x[row] = x
+        self.previous_left[row] = x
+        self.vel_x[row] = ENEMY_SPEED
+        self.animation_counter[row] = 0
+        self.groups_dirty = True
+        return handle
+
+    def set_platforms(self, platforms):
+        self.platforms = platforms
+        self.platforms_dirty = True
+
+    def _rebuild_edges(self):
+        n = self.count
+        if self.groups_dirty:
+            bottoms, group = np.unique(self.top[:n] + ENEMY_HEIGHT, return_inverse=True)
+            self.group_bottoms = bottoms
+            self.group_key[:n] = (group.reshape(-1) << EDGE_KEY_GROUP_SHIFT) + EDGE_KEY_BIAS
+        rects = [platform.rect for platform in self.platforms]
+        lefts = np.array([rect.left for rect in rects], dtype=np.int64)
+        rights = np.array([rect.right for rect in rects], dtype=np.int64)
+        tops = np.array([rect.top for rect in rects], dtype=np.int64)
+        bottoms = np.array([rect.bottom for rect in rects], dtype=np.int64)
+        # 足元の帯と縦に重なる (高さのグループ, 足場) の組
+        feet = self.group_bottoms[:, None]
+        groups, indices = np.nonzero((feet < bottoms[None, :]) & (tops[None, :] < feet + ENEMY_FOOT_DEPTH))
+        base = (groups << EDGE_KEY_GROUP_SHIFT) + EDGE_KEY_BIAS
+        self.edges = np.sort(np.concatenate((base + lefts[indices], base + EDGE_KEY_RIGHT + rights[indices])))
+        self.platforms_dirty = False
+        self.groups_dirty = False
+        self.limits_dirty = True
+
+    def _find_limits(self, rows):
+        # 次のフレームに動いた後の位置を rx として、
+        # 右向きは rx より右にある最初の右端、左向きは rx + w - 1 以下で最後の左端
+        vel_x = self.vel_x[rows]
+        left = np.trunc(self.left[rows] + vel_x).astype(np.int64)
+        forward = vel_x > 0
+        probe = self.group_key[rows] + np.where(forward, EDGE_KEY_RIGHT + left, left + (ENEMY_WIDTH - 1))
+        edges = self.edges
+        found = np.searchsorted(edges, probe, "right") - ~forward
+        valid = (found >= 0) & (found < len(edges))
+        if len(edges):
+            entry = edges[np.clip(found, 0, len(edges) - 1)]
+            valid &= (entry >> 32) == (probe >> 32)
+            coordinate = (entry & 0xFFFFFFFF) - EDGE_KEY_BIAS
+        else:
+            coordinate = 0
+        self.limit[rows] = np.where(valid, coordinate, np.where(forward, NO_EDGE_AHEAD, NO_EDGE_BEHIND))
+
+    def remember(self):
+        # 描画の補間に使う、1ステップ前の位置
+        n = self.count
+        self.previous_left[:n] = self.left[:n]
+
+    def update(self, active, world_width=SCREEN_WIDTH):
+        # activeと重なる（起きている）敵だけを動かす
+        n = self.count
+        if not n:
+            return
+        if self.platforms_dirty or self.groups_dirty:
+            self._rebuild_edges()
+        if self.limits_dirty:
+            self._find_limits(np.arange(n))
+            self.limits_dirty = False
+        if n < SCALAR_ROW_LIMIT:
+            self._update_rows(self._row_list_overlapping(active), world_width)
+            return
+        awake = self.rows_overlapping(active)
+        if not len(awake):
+            return
+        width = ENEMY_WIDTH
+        vel_x = self.vel_x[awake]
+        moved = self.x[awake] + vel_x
+        left = np.trunc(moved).astype(np.int64)
+        next_left = np.trunc(left + vel_x).astype(np.int64)
+        limit = self.limit[awake]
+        turned = ((vel_x > 0) & (limit <= next_left)) | ((vel_x < 0) & (limit > next_left + (width - 1)))
+        vel_x[turned] *= -1
+
+        at_left = left <= 0
+        at_right = (left >= world_width - width) & ~at_left
+        bounced = at_left | at_right
+        if bounced.any():
+            left[at_left] = 0
+            left[at_right] = world_width - width
+            moved[bounced] = left[bounced]
+            vel_x[bounced] *= -1
+            turned |= bounced
+
+        self.x[awake] = moved
+        self.left[awake] = left
+        self.vel_x[awake] = vel_x
+        self.animation_counter[awake] += 1
+        if turned.any():
+            self._find_limits(awake[turned])
+
+    def _update_rows(self, rows, world_width):
+        # update() を1体ずつ行うもの。結果は配列版と同じになる
+        width = ENEMY_WIDTH
+        xs = self.x
+        lefts = self.left
+        velocities = self.vel_x
+        limits = self.limit
+        counters = self.animation_counter
+        turned_rows = []
+        for row in rows:
+            vel_x = float(velocities[row])
+            moved = float(xs[row]) + vel_x
+            left = int(moved)
+            next_left = int(left + vel_x)
+            limit = int(limits[row])
+            turned = (vel_x > 0 and limit <= next_left) or (vel_x < 0 and limit > next_left + (width - 1))
+            if turned:
+                vel_x = -vel_x
+            if left <= 0 or left >= world_width - width:
+                left = 0 if left <= 0 else world_width - width
+                moved = float(left)
+                vel_x = -vel_x
+                turned = True
+            xs[row] = moved
+            lefts[row] = left
+            velocities[row] = vel_x
+            counters[row] += 1
+            if turned:
+                turned_rows.append(row)
+        if turned_rows:
+            self._find_limits(np.array(turned_rows, dtype=np.intp))
+
+    def draw(self, screen, cull, offset=(0, 0), alpha=1.0):
+        # cullと重なる敵を level_id 順に描いて、描いた範囲のリストを返す
+        if not self.count:
+            return []
+        visible = self.in_level_order(self.rows_overlapping(cull))
+        left = self.left[visible]
+        if alpha < 1:
+            previous = self.previous_left[visible]
+            left = previous + np.rint((left - previous) * alpha).astype(np.int64)
+        ox, oy = offset
+        sin = math.sin
+        draw = enemy_atlas.draw
+        return [draw(screen, x - ox, top - oy, sin(counter * 0.2) * 3, sin(counter * 0.3) * 3)
+                for x, top, counter in zip(left.tolist(), self.top[visible].tolist(),
+                                            self.animation_counter[visible].tolist())]
+
+    def state_bytes(self):
+        # level_id順に1体ずつ struct.pack("<Iddq", level_id, x, vel_x, animation_counter) したものと同じバイト列
+        rows = self.in_level_order(np.arange(self.count))
+        packed = np.empty(len(rows), dtype=[("level_id", "<u4"), ("x", "<f8"), ("vel_x", "<f8"),
+                                            ("animation_counter", "<i8")])
+        packed["level_id"] = self.level_id[rows]
+        packed["x"] = self.x[rows]
+        packed["vel_x"] = self.vel_x[rows]
+        packed["animation_counter"] = self.animation_counter[rows]
+        return packed.tobytes()
+
+# コインの回転アニメーション
+# 回転は周期的で全コイン共通（位相だけが違う）なので、一周分をコマ送りで焼いておく。
+# 敵と同じく、RLEのまま範囲指定で描かないようにコマごとに別のサーフェスにする。
+COIN_SIZE = 30
+COIN_SPIN_PERIOD = math.pi / 0.05
+COIN_SPIN_FRAMES = 64
+
+def paint_coin(surface, cx, cy, width):
+    if width > 2:
+        pygame.draw.ellipse(surface, GOLD, 
+                          (cx - width/2, cy - 15, width, 30))
+        pygame.draw.ellipse(surface, YELLOW, 
+                          (cx - width/2 + 2, cy - 13, width - 4, 26))
+        if width > 20:
+            star_points = []
+            for i in range(10):
+                angle = i * math.pi / 5
+                r = 8 if i % 2 == 0 else 4
+                px = cx + r * math.cos(angle - math.pi / 2)
+                py = cy + r * math.sin(angle - math.pi / 2)
+                star_points.append((px, py))
+            pygame.draw.polygon(surface, GOLD, star_points)
+        if width > 15:
+            pygame.draw.ellipse(surface, WHITE, 
+                              (cx - width/4, cy - 8, width/2, 8))
+
+class CoinStrip:
+    def __init__(self, frames=COIN_SPIN_FRAMES):
+        self.frames = frames
+        self.surfaces = []
+
+    def build(self):
+        surfaces = []
+        for k in range(self.frames):
+            animation_counter = k * COIN_SPIN_PERIOD / self.frames
+            width = abs(30 * math.cos(animation_counter * 0.05))
+            surface = _keyed_surface((COIN_SIZE, COIN_SIZE))
+            paint_coin(surface, COIN_SIZE // 2, COIN_SIZE // 2, width)
+            surfaces.append(_to_display_format(surface))
+        self.surfaces = surfaces
+
+    def draw(self, screen, x, y, animation_counter):
+        if not self.surfaces:
+            self.build()
+        k = int(round(animation_counter * self.frames / COIN_SPIN_PERIOD)) % self.frames
+        return screen.blit(self.surfaces[k], (x, y))
+
+coin_strip = CoinStrip()
+
+class CoinStore(EntityStore):
+    columns = EntityStore.columns + (("phase", np.int64),)
+    width = COIN_SIZE
+    height = COIN_SIZE
+
+    def spawn(self, x, y, level_id=0, phase=0):
+        handle = self.create(x, y, level_id)
+        self.phase[self.count - 1] = phase
+        return handle
+
+    def spawn_sparkles(self, sparkles, frame, active, rng=random):
+        # 活動範囲のコインのうち、このフレームに光るものから level_id 順にきらめきを出す
+        if not self.count:
+            return
+        rows = self.rows_overlapping(active)
+        rows = self.in_level_order(rows[(frame + self.phase[rows]) % 10 == 0])
+        half = COIN_SIZE // 2
+        for cx, cy in zip((self.left[rows] + half).tolist(), (self.top[rows] + half).tolist()):
+            angle = rng.uniform(0, 2 * math.pi)
+            dist = rng.uniform(15, 25)
+            sparkles.emit(cx + math.cos(angle) * dist, cy + math.sin(angle) * dist,
+                          life=SPARKLE_LIFE)
+
+    def draw(self, screen, frame, cull, offset=(0, 0)):
+        # cullと重なるコインを level_id 順に描いて、描いた範囲のリストを返す
+        if not self.count:
+            return []
+        visible = self.in_level_order(self.rows_overlapping(cull))
+        ox, oy = offset
+        draw = coin_strip.draw
+        return [draw(screen, x - ox, y - oy, frame + phase)
+                for x, y, phase in zip(self.left[visible].tolist(), self.top[visible].tolist(),
+                                       self.phase[visible].tolist())]
+
+# 背景レイヤー
+# 静的な背景は一度だけオフスクリーンに描画してキャッシュし、毎フレームはblitするだけにする。
+# 解像度かパレットが変わった時だけ作り直す。
+BACKGROUND_PALETTE = {
+    'sky_top': LIGHT_SKY_BLUE_GRADIENT_TOP,
+    'sky': SKY_BLUE,
+    'sun': YELLOW,
+    'sun_inner': (255, 255, 200),
+    'cloud': WHITE,
+    'cloud_shade': (200, 200, 200),
+    'mountain_far': MOUNTAIN_FAR,
+    'mountain_mid': MOUNTAIN_MID,
+    'mountain_near': MOUNTAIN_NEAR,
+    'tree_trunk': TREE_TRUNK,
+    'tree_leaf_light': TREE_LEAF_LIGHT,
+    'tree_leaf_dark': TREE_LEAF_DARK,
+}
+
+def _to_display_format(surface, alpha=False):
+    # 画面がまだ無い（ヘッドレス等）場合は変換できないのでそのまま使う
+    if pygame.display.get_surface() is None:
+        return surface
+    return surface.convert_alpha() if alpha else surface.convert()
+
+def render_sky(surface, palette):
+    width, height = surface.get_size()
+    half = height // 2
+    top = np.array(palette['sky_top'], dtype=np.float64)
+    sky = np.array(palette['sky'], dtype=np.float64)
+    progress = np.arange(half, dtype=np.float64)[:, None] / half
+    column = np.empty((height, 3), dtype=np.int64)
+    column[:half] = (top * (1 - progress) + sky * progress).astype(np.int64)
+    column[half:] = palette['sky']
+    np.clip(column, 0, 255, out=column)
+    pygame.surfarray.blit_array(surface, np.broadcast_to(column, (width, height, 3)))
+
+def render_sun(surface, palette):
     sun_x, sun_y = 850, 100
-    pygame.draw.circle(screen, YELLOW, (sun_x, sun_y), 40)
-    pygame.draw.circle(screen, (255, 255, 200), (sun_x, sun_y), 35)
+    pygame.draw.circle(surface, palette['sun'], (sun_x, sun_y), 40)
+    pygame.draw.circle(surface, palette['sun_inner'], (sun_x, sun_y), 35)
     for i in range(12):
         angle = i * math.pi / 6
         start_x = sun_x + 50 * math.cos(angle)
         start_y = sun_y + 50 * math.sin(angle)
         end_x = sun_x + 70 * math.cos(angle)
         end_y = sun_y + 70 * math.sin(angle)
-        pygame.draw.line(screen, YELLOW, (start_x, start_y), (end_x, end_y), 3)
-    
+        pygame.draw.line(surface, palette['sun'], (start_x, start_y), (end_x, end_y), 3)
+
+def render_clouds(surface, palette):
+    shade = palette['cloud_shade']
+    cloud = palette['cloud']
     cloud_positions = [(100, 100), (400, 150), (700, 80), (900, 130)]
     for x, y in cloud_positions:
-        pygame.draw.ellipse(screen, (200, 200, 200, 150), (x + 5, y + 5, 80, 40))
-        pygame.draw.ellipse(screen, (200, 200, 200, 150), (x - 15, y + 15, 60, 35))
-        pygame.draw.ellipse(screen, (200, 200, 200, 150), (x + 45, y + 15, 60, 35))
-        pygame.draw.ellipse(screen, WHITE, (x, y, 80, 40))
-        pygame.draw.ellipse(screen, WHITE, (x - 20, y + 10, 60, 35))
-        pygame.draw.ellipse(screen, WHITE, (x + 40, y + 10, 60, 35))
-        pygame.draw.ellipse(screen, WHITE, (x + 10, y - 10, 60, 40))
-    
-    pygame.draw.polygon(screen, MOUNTAIN_FAR, [
-        (-100, SCREEN_HEIGHT), (150, SCREEN_HEIGHT // 2 - 20),
-        (300, SCREEN_HEIGHT // 2 - 60), (500, SCREEN_HEIGHT // 2 - 10),
-        (650, SCREEN_HEIGHT)])
-    pygame.draw.polygon(screen, MOUNTAIN_MID, [
-        (100, SCREEN_HEIGHT), (350, SCREEN_HEIGHT // 2 + 30),
-        (550, SCREEN_HEIGHT // 2 - 0), (750, SCREEN_HEIGHT)])
-    pygame.draw.polygon(screen, MOUNTAIN_NEAR, [
-        (450, SCREEN_HEIGHT), (650, SCREEN_HEIGHT // 2 + 80),
-        (800, SCREEN_HEIGHT // 2 + 40), (SCREEN_WIDTH + 50, SCREEN_HEIGHT)])
-    
+        pygame.draw.ellipse(surface, shade, (x + 5, y + 5, 80, 40))
+        pygame.draw.ellipse(surface, shade, (x - 15, y + 15, 60, 35))
+        pygame.draw.ellipse(surface, shade, (x + 45, y + 15, 60, 35))
+        pygame.draw.ellipse(surface, cloud, (x, y, 80, 40))
+        pygame.draw.ellipse(surface, cloud, (x - 20, y + 10, 60, 35))
+        pygame.draw.ellipse(surface, cloud, (x + 40, y + 10, 60, 35))
+        pygame.draw.ellipse(surface, cloud, (x + 10, y - 10, 60, 40))
+
+def render_mountains(surface, palette):
+    width, height = surface.get_size()
+    ridges = [
+        ('mountain_far', [(-100, height), (150, height // 2 - 20),
+                          (300, height // 2 - 60), (500, height // 2 - 10),
+                          (650, height)]),
+        ('mountain_mid', [(100, height), (350, height // 2 + 30),
+                          (550, height // 2 - 0), (750, height)]),
+        ('mountain_near', [(450, height), (650, height // 2 + 80),
+                           (800, height // 2 + 40), (width + 50, height)]),
+    ]
+    # この層は横に繰り返して描くので、左右に一画面ずらした分も描いて継ぎ目をなくす
+    for color, points in ridges:
+        for shift in (-width, 0, width):
+            pygame.draw.polygon(surface, palette[color], [(x + shift, y) for x, y in points])
+
+def render_trees(surface, palette):
     # 木のY座標を地面基準に修正
-    ground_y = SCREEN_HEIGHT - 60 # 地面のY座標 (Platformの地面と同じ高さ)
-    tree_total_height = 80 # 木の全体の高さ（葉の上端から幹の下端まで）
+    ground_y = surface.get_height() - 60 # 地面のY座標 (Platformの地面と同じ高さ)
     trunk_height = 30 # 幹の高さ
     
     # tree_positionsのX座標のみ使用し、Y座標は地面基準で計算
@@ -485,133 +1370,2037 @@ def draw_background(screen):
         leaf_radius_sub3 = int(23 * current_scale)
 
         # 幹
-        pygame.draw.rect(screen, TREE_TRUNK, 
+        pygame.draw.rect(surface, palette['tree_trunk'], 
                          (tx_center - trunk_width // 2, trunk_top_y, trunk_width, current_trunk_height))
         # 葉
-        pygame.draw.circle(screen, TREE_LEAF_DARK, (tx_center, leaf_center_y), leaf_radius_main)
-        pygame.draw.circle(screen, TREE_LEAF_LIGHT, (tx_center - int(5*current_scale), leaf_center_y - int(3*current_scale)), leaf_radius_sub1)
-        pygame.draw.circle(screen, TREE_LEAF_DARK, (tx_center + int(3*current_scale), leaf_center_y + int(10*current_scale)), leaf_radius_sub2)
-        pygame.draw.circle(screen, TREE_LEAF_LIGHT, (tx_center, leaf_center_y + int(7*current_scale)), leaf_radius_sub3)
+        pygame.draw.circle(surface, palette['tree_leaf_dark'], (tx_center, leaf_center_y), leaf_radius_main)
+        pygame.draw.circle(surface, palette['tree_leaf_light'], (tx_center - int(5*current_scale), leaf_center_y - int(3*current_scale)), leaf_radius_sub1)
+        pygame.draw.circle(surface, palette['tree_leaf_dark'], (tx_center + int(3*current_scale), leaf_center_y + int(10*current_scale)), leaf_radius_sub2)
+        pygame.draw.circle(surface, palette['tree_leaf_light'], (tx_center, leaf_center_y + int(7*current_scale)), leaf_radius_sub3)
 
+class BackgroundLayer:
+    def __init__(self, name, render, scroll=0.0):
+        self.name = name
+        self.render = render
+        self.scroll = scroll
 
-current_platforms_for_shadow = []
+class Background:
+    def __init__(self, palette=None):
+        self.set_palette(palette if palette is not None else BACKGROUND_PALETTE)
+        self.layers = []
+        self.passes = []
+        self.built_key = None
 
-def main():
-    global current_platforms_for_shadow
+    def add_layer(self, name, render, scroll=0.0):
+        # render(surface, palette) は一度だけ呼ばれる。scrollはカメラ移動に対する視差の係数
+        self.layers.append(BackgroundLayer(name, render, scroll))
+        self.built_key = None
 
-    player = Player(100, 400)
-    
-    platforms = [
-        Platform(0, SCREEN_HEIGHT - 60, SCREEN_WIDTH, 60, "ground"),
-        Platform(200, SCREEN_HEIGHT - 60 - 100, 150, 20, "brick"),
-        Platform(400, SCREEN_HEIGHT - 60 - 200, 150, 20, "brick"),
-        Platform(600, SCREEN_HEIGHT - 60 - 300, 150, 20, "brick"),
-        Platform(300, SCREEN_HEIGHT - 60 - 100, 60, 100, "pipe"),
-        Platform(700, SCREEN_HEIGHT - 60 - 150, 60, 150, "pipe"),
-        Platform(850, SCREEN_HEIGHT - 60 - 150, 100, 20, "brick"),
-        Platform(50, SCREEN_HEIGHT - 60 - 250, 100, 20, "brick"),
-    ]
-    current_platforms_for_shadow = platforms
+    def remove_layer(self, name):
+        self.layers = [layer for layer in self.layers if layer.name != name]
+        self.built_key = None
+
+    def set_palette(self, palette):
+        # 描き直しが要るかを比べるキーは色が変わった時にだけ作る
+        self.palette = dict(palette)
+        self.palette_key = tuple(sorted(self.palette.items()))
+
+    def invalidate(self):
+        self.built_key = None
+
+    def _key(self, size):
+        return (size, self.palette_key)
+
+    def build(self, size):
+        # 同じscrollを持つ連続したレイヤーは一枚のサーフェスにまとめる
+        self.passes = []
+        for layer in self.layers:
+            if self.passes and self.passes[-1][0] == layer.scroll:
+                surface = self.passes[-1][1]
+            else:
+                if self.passes:
+                    surface = _keyed_surface(size)
+                else:
+                    surface = pygame.Surface(size)
+                self.passes.append([layer.scroll, surface])
+            layer.render(surface, self.palette)
+        for layer_pass in self.passes:
+            layer_pass[1] = _to_display_format(layer_pass[1])
+        self.built_key = self._key(size)
+
+    def draw(self, screen, scroll_x=0):
+        size = screen.get_size()
+        if self.built_key != self._key(size):
+            self.build(size)
+        width = size[0]
+        for scroll, surface in self.passes:
+            offset = int(scroll_x * scroll) % width if scroll else 0
+            if offset:
+                screen.blit(surface, (-offset, 0))
+                screen.blit(surface, (width - offset, 0))
+            else:
+                screen.blit(surface, (0, 0))
+
+background = Background()
+background.add_layer("sky", render_sky)
+background.add_layer("sun", render_sun)
+background.add_layer("clouds", render_clouds)
+background.add_layer("mountains", render_mountains, scroll=0.25)
+background.add_layer("trees", render_trees, scroll=0.5)
+
+def draw_background(screen, scroll_x=0):
+    background.draw(screen, scroll_x)
+
+def draw_static_scene(surface, platforms, offset=(0, 0), backdrop=None):
+    # backdrop には足場を描く前の背景を写しておく
+    draw_background(surface, offset[0])
+    if backdrop is not None:
+        backdrop.blit(surface, (0, 0))
+    for platform in platforms:
+        platform.draw_art(surface, platform.rect.x - offset[0], platform.rect.y - offset[1])
+
+# 差分矩形描画
+# 動いたスプライトの前フレームと今フレームの矩形だけを静的シーンから復元し、
+# その矩形だけを画面に送る。汚れた面積が大きすぎる時は全画面flipに戻す。
+# カメラが動いている間は静的シーンを毎フレーム作り直すより普通に全体を描く方が安いので、
+# シーンが前のフレームと同じになった（止まった）時にだけ作る。
+# 揺れる草は静的シーンに焼いておき、揺れのコマが変わった時だけ草の帯を静的シーンに描き直す。
+class DirtyRectRenderer:
+    def __init__(self, screen, max_dirty_fraction=0.4):
+        self.screen = screen
+        self.max_dirty_fraction = max_dirty_fraction
+        self.static = None
+        self.backdrop = None
+        self.grass_frame = None
+        self.scene_key = None
+        self.last_key = None
+        self.previous = []
+        self.dirty = []
+        self.full_redraw = True
+
+    def set_scene(self, render, key=None):
+        if self.static is None or self.static.get_size() != self.screen.get_size():
+            self.static = _to_display_format(pygame.Surface(self.screen.get_size()))
+            self.backdrop = _to_display_format(pygame.Surface(self.screen.get_size()))
+        render(self.static, self.backdrop)
+        self.scene_key = key
+        self.grass_frame = None
+        self.full_redraw = True
+
+    def invalidate(self):
+        self.full_redraw = True
+
+    def scrolling(self, key):
+        # 動いている間は画面全体を描き直すので、今の静的シーンとも合わなくなる
+        moving = key != self.last_key
+        self.last_key = key
+        if moving:
+            self.scene_key = None
+            self.full_redraw = True
+        return moving
+
+    def begin(self):
+        if self.full_redraw:
+            self.screen.blit(self.static, (0, 0))
+        else:
+            for rect in self.previous:
+                self.screen.blit(self.static, rect, rect)
+        self.dirty = []
+
+    def add(self, rect):
+        if rect:
+            self.dirty.append(rect)
+
+    def present(self, full=False):
+        screen_rect = self.screen.get_rect()
+        current = [rect.clip(screen_rect) for rect in self.dirty]
+        rects = self.previous + current
+        area = sum(rect.width * rect.height for rect in rects)
+        if full or self.full_redraw or area > screen_rect.width * screen_rect.height * self.max_dirty_fraction:
+            pygame.display.flip()
+        else:
+            pygame.display.update(rects)
+        self.previous = current
+        self.dirty = []
+        # オーバーレイは画面全体を覆うので、次のフレームも全体を復元する
+        self.full_redraw = full
 
-    for p in platforms:
-        if p.type == "pipe":
-            p.rect.bottom = SCREEN_HEIGHT - 60
+# 描画リソース
+# フォント・文字列の描画結果・オーバーレイ・影は一度作ったものを使い回し、
+# 定常状態のフレームでは新しいサーフェスを作らない。
+SHADOW_SIZE_STEP = 2
+SHADOW_ALPHA_STEP = 10
+
+class RenderResources:
+    def __init__(self, text_cache_size=128):
+        self.fonts = {}
+        self.text_cache = OrderedDict()
+        self.text_cache_size = text_cache_size
+        self.overlays = {}
+        self.shadows = {}
+
+    def font(self, name=None, size=36):
+        key = (name, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = pygame.font.Font(name, size)
+        return font
+
+    def text(self, string, color, name=None, size=36):
+        key = (string, color, name, size)
+        surface = self.text_cache.get(key)
+        if surface is not None:
+            self.text_cache.move_to_end(key)
+            return surface
+        surface = self.font(name, size).render(string, True, color)
+        self.text_cache[key] = surface
+        if len(self.text_cache) > self.text_cache_size:
+            self.text_cache.popitem(last=False)
+        return surface
+
+    def message_overlay(self, size, fill, string, text_color, panel_color, border_color):
+        # 画面全体を薄く覆い、中央に枠付きのメッセージを出すオーバーレイ
+        key = (size, fill, string, text_color, panel_color, border_color)
+        overlay = self.overlays.get(key)
+        if overlay is None:
+            overlay = pygame.Surface(size, pygame.SRCALPHA)
+            overlay.fill(fill)
+            text = self.font().render(string, True, text_color)
+            text_rect = text.get_rect(center=(size[0] // 2, size[1] // 2))
+            bg_rect = text_rect.inflate(20, 20)
+            pygame.draw.rect(overlay, panel_color, bg_rect, border_radius=10)
+            pygame.draw.rect(overlay, border_color, bg_rect, 3, border_radius=10)
+            overlay.blit(text, text_rect)
+            overlay = self.overlays[key] = _to_display_format(overlay, alpha=True)
+        return overlay
+
+    def shadow(self, width, height, alpha):
+        # 大きさと濃さを量子化して、キャッシュする影の種類を抑える
+        width -= width % SHADOW_SIZE_STEP
+        height -= height % SHADOW_SIZE_STEP
+        alpha -= alpha % SHADOW_ALPHA_STEP
+        if width <= 0 or height <= 0 or alpha <= 0:
+            return None
+        key = (width, height, alpha)
+        shadow = self.shadows.get(key)
+        if shadow is None:
+            shadow = pygame.Surface((width, height), pygame.SRCALPHA)
+            pygame.draw.ellipse(shadow, (0, 0, 0, alpha), shadow.get_rect())
+            shadow = self.shadows[key] = _to_display_format(shadow, alpha=True)
+        return shadow
+
+resources = RenderResources()
+
+# フレームプロファイラー
+# フレームをフェーズに分けて時間を計り、直近のフレームをリングバッファに残す。
+# 無効の時は mark() が属性を1つ見て戻るだけなので、計測しない時の負荷はほぼない。
+PROFILER_PHASES = ("events", "player", "enemies", "streaming", "background", "platforms", "coins",
+                   "particles", "enemy_draw", "player_draw", "hud", "flip", "tick")
+(PHASE_EVENTS, PHASE_PLAYER, PHASE_ENEMIES, PHASE_STREAMING, PHASE_BACKGROUND, PHASE_PLATFORMS,
+ PHASE_COINS, PHASE_PARTICLES, PHASE_ENEMY_DRAW, PHASE_PLAYER_DRAW, PHASE_HUD, PHASE_FLIP,
+ PHASE_TICK) = range(len(PROFILER_PHASES))
+PROFILER_FRAMES = 240
+PROFILER_OVERLAY_SIZE = (320, 250)
+PROFILER_OVERLAY_REFRESH = 15
+PROFILER_COLORS = ((230, 90, 90), (240, 160, 60), (230, 210, 70), (150, 210, 80), (80, 190, 120),
+                   (70, 200, 200), (80, 150, 240), (130, 110, 240), (190, 100, 220), (230, 110, 170),
+                   (200, 200, 200), (150, 150, 150), (100, 100, 100))
+
+class FrameProfiler:
+    def __init__(self, capacity=PROFILER_FRAMES):
+        self.capacity = capacity
+        self.enabled = False
+        self.visible = False
+        self.starts = np.zeros(capacity, dtype=np.int64)
+        self.durations = np.zeros((capacity, len(PROFILER_PHASES)), dtype=np.int64)
+        self.count = 0
+        self.row = None
+        self.frame_start = 0
+        self.last = 0
+        self.overlay = None
+        self.overlay_age = 0
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        if not enabled:
+            self.row = None
+
+    def clear(self):
+        self.count = 0
+        self.overlay = None
+
+    def begin_frame(self):
+        if self.enabled:
+            self.row = [0] * len(PROFILER_PHASES)
+            self.frame_start = self.last = time.perf_counter_ns()
+
+    def mark(self, phase):
+        # 前の mark からの時間をこのフェーズに足す
+        row = self.row
+        if row is not None:
+            now = time.perf_counter_ns()
+            row[phase] += now - self.last
+            self.last = now
+
+    def end_frame(self):
+        row = self.row
+        if row is not None:
+            index = self.count % self.capacity
+            self.starts[index] = self.frame_start
+            self.durations[index] = row
+            self.count += 1
+            self.row = None
+
+    def frames(self):
+        # 古い順に (開始時刻, フェーズごとの時間) を返す。単位はナノ秒
+        n = min(self.count, self.capacity)
+        order = (np.arange(self.count - n, self.count) % self.capacity)
+        return self.starts[order], self.durations[order]
+
+    def export(self, path):
+        if path.endswith(".json"):
+            self.export_trace(path)
+        else:
+            self.export_csv(path)
+
+    def export_csv(self, path):
+        starts, durations = self.frames()
+        first = self.count - len(starts)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(",".join(("frame", "start_ms", "total_ms") + tuple(f"{phase}_ms" for phase in PROFILER_PHASES)) + "\n")
+            base = starts[0] if len(starts) else 0
+            for i, (start, row) in enumerate(zip(starts.tolist(), durations.tolist())):
+                f.write(",".join([str(first + i), f"{(start - base) / 1e6:.4f}", f"{sum(row) / 1e6:.4f}"] +
+                                 [f"{value / 1e6:.4f}" for value in row]) + "\n")
+
+    def export_trace(self, path):
+        # chrome://tracing や Perfetto で開ける Trace Event 形式
+        starts, durations = self.frames()
+        first = self.count - len(starts)
+        events = []
+        for i, (start, row) in enumerate(zip(starts.tolist(), durations.tolist())):
+            events.append({"name": f"frame {first + i}", "ph": "X", "pid": 1, "tid": 1,
+                           "ts": start / 1000, "dur": sum(row) / 1000})
+            # フェーズは mark() の順に並んでいるので、開始時刻は累積で求まる
+            offset = start
+            for phase, value in zip(PROFILER_PHASES, row):
+                if value:
+                    events.append({"name": phase, "ph": "X", "pid": 1, "tid": 2,
+                                   "ts": offset / 1000, "dur": value / 1000})
+                offset += value
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def draw(self, screen):
+        # 数字が毎フレーム変わると読めないので、数フレームごとに描き直す
+        if self.overlay is None or self.overlay_age >= PROFILER_OVERLAY_REFRESH:
+            self.overlay = self.render_overlay()
+            self.overlay_age = 0
+        self.overlay_age += 1
+        return screen.blit(self.overlay, (screen.get_width() - PROFILER_OVERLAY_SIZE[0] - 10, 10))
+
+    def render_overlay(self):
+        width, height = PROFILER_OVERLAY_SIZE
+        overlay = pygame.Surface(PROFILER_OVERLAY_SIZE, pygame.SRCALPHA)
+        overlay.fill((0, 0, 0, 170))
+        font = resources.font(None, 18)
+        _, durations = self.frames()
+        if not len(durations):
+            overlay.blit(font.render("profiling...", True, WHITE), (10, 10))
+            return overlay
+        totals = durations.sum(axis=1) / 1e6
+        means = durations.mean(axis=0) / 1e6
+        budget = 1000 / FPS
+
+        # フレーム時間のグラフ（横線は1フレームの予算）
+        graph = pygame.Rect(10, 10, width - 20, 60)
+        scale = graph.height / max(budget * 2, float(totals.max()))
+        pygame.draw.rect(overlay, (40, 40, 40, 200), graph)
+        budget_y = graph.bottom - budget * scale
+        pygame.draw.line(overlay, (90, 200, 90), (graph.left, budget_y), (graph.right - 1, budget_y))
+        step = graph.width / self.capacity
+        points = [(graph.left + i * step, graph.bottom - 1 - value * scale) for i, value in enumerate(totals.tolist())]
+        if len(points) > 1:
+            pygame.draw.lines(overlay, WHITE, False, points)
+        summary = (f"frame {totals.mean():.2f} ms  p99 {np.percentile(totals, 99):.2f}  "
+                   f"max {totals.max():.2f}")
+        overlay.blit(font.render(summary, True, WHITE), (10, graph.bottom + 4))
+
+        # フェーズごとの平均時間のバー
+        y = graph.bottom + 22
+        bar_left = 95
+        bar_width = width - bar_left - 60
+        for phase, mean, color in zip(PROFILER_PHASES, means.tolist(), PROFILER_COLORS):
+            overlay.blit(font.render(phase, True, WHITE), (10, y))
+            pygame.draw.rect(overlay, color, (bar_left, y + 2, max(1, min(bar_width, int(mean / budget * bar_width))), 9))
+            overlay.blit(font.render(f"{mean:.2f}", True, WHITE), (width - 55, y))
+            y += 12
+        return overlay
+
+profiler = FrameProfiler()
+
+# 品質の自動調整
+# 描画にかかった時間（clock.tick で待つ前まで）を直近 QUALITY_WINDOW フレーム分見て、
+# 予算（1フレームの時間）を超えそうなら飾りの描画を一段落とし、十分に余裕が続いたら一段戻す。
+# 落とす基準（予算の90%）と戻す基準（50%）を離し、戻した直後にまた落ちた時は次に戻すまでの
+# 待ち時間を倍にして、段階が行ったり来たりしないようにする。
+# シミュレーションには触れない（羽根やきらめきの数を減らしても乱数の使い方は変わらない）。
+SHADOW_SOFT = "soft"
+SHADOW_SIMPLE = "simple"
+SHADOW_NONE = "none"
+QualityTier = namedtuple('QualityTier', ['name', 'feathers', 'sparkles', 'grass', 'shadow', 'scale'])
+QUALITY_TIERS = (
+    QualityTier("high", 256, 4096, True, SHADOW_SOFT, 1.0),
+    QualityTier("medium", 64, 512, True, SHADOW_SOFT, 1.0),
+    QualityTier("low", 16, 128, False, SHADOW_SIMPLE, 1.0),
+    QualityTier("lowest", 0, 0, False, SHADOW_NONE, 0.5),
+)
+QUALITY_AUTO = "auto"
+QUALITY_WINDOW = 30
+QUALITY_DOWNGRADE = 0.9
+QUALITY_UPGRADE = 0.5
+QUALITY_UPGRADE_DELAY = 180
+QUALITY_MAX_UPGRADE_DELAY = QUALITY_UPGRADE_DELAY * 8
+
+class QualityGovernor:
+    def __init__(self, tiers=QUALITY_TIERS, budget=1.0 / FPS):
+        self.tiers = tiers
+        self.budget = budget
+        self.level = 0
+        self.auto = False
+        self.samples = deque(maxlen=QUALITY_WINDOW)
+        self.frames_at_level = 0
+        self.upgrade_delay = QUALITY_UPGRADE_DELAY
+        self.upgraded = False
+
+    @property
+    def tier(self):
+        return self.tiers[self.level]
+
+    def set_level(self, level):
+        self.level = max(0, min(level, len(self.tiers) - 1))
+        self.samples.clear()
+        self.frames_at_level = 0
+
+    def set_mode(self, mode):
+        # "auto" か段階の名前
+        self.auto = mode == QUALITY_AUTO
+        if not self.auto:
+            names = [tier.name for tier in self.tiers]
+            if mode not in names:
+                raise ValueError(f"unknown quality '{mode}' (choose from {QUALITY_AUTO}, {', '.join(names)})")
+            self.set_level(names.index(mode))
+
+    def record(self, frame_time):
+        # 1フレームの描画時間（秒）を渡す。段階が変わったらTrue
+        if not self.auto:
+            return False
+        self.samples.append(frame_time)
+        self.frames_at_level += 1
+        if len(self.samples) < QUALITY_WINDOW:
+            return False
+        recent = sorted(self.samples)[len(self.samples) * 9 // 10]
+        if recent > self.budget * QUALITY_DOWNGRADE and self.level < len(self.tiers) - 1:
+            if self.upgraded:
+                # 戻したばかりの段階が重すぎた
+                self.upgrade_delay = min(self.upgrade_delay * 2, QUALITY_MAX_UPGRADE_DELAY)
+            self.upgraded = False
+            self.set_level(self.level + 1)
+            return True
+        if (recent < self.budget * QUALITY_UPGRADE and self.level > 0
+                and self.frames_at_level >= self.upgrade_delay):
+            self.upgraded = True
+            self.set_level(self.level - 1)
+            return True
+        if self.upgraded and self.frames_at_level >= self.upgrade_delay:
+            # 戻した段階で落ち着いた
+            self.upgraded = False
+            self.upgrade_delay = QUALITY_UPGRADE_DELAY
+        return False
+
+    def apply(self, world):
+        tier = self.tier
+        world.player.feathers.limit = min(tier.feathers, world.player.feathers.capacity)
+        world.sparkles.limit = min(tier.sparkles, world.sparkles.capacity)
+
+quality = QualityGovernor()
+
+# メモリとGC
+# GcPolicy: ゲーム中は自動のGCを止め、レベルを読み込んだ後に一度集めて gc.freeze() で
+# 残った物を以後のGCの対象から外す。集めるのはゲームオーバー・クリア・リスタートの切り替わりと、
+# 予算に余裕のあるフレーム（CPythonと同じ世代のしきい値で世代を選ぶ）だけにする。
+# 余裕の無いフレームが続いても GC_FORCE_PENDING を超えたら集める。
+# AllocationTracker: 診断用。フレームの終わりごとに生きているブロックを前のフレームの終わりと比べ、
+# 生きている量がそれまでの最大を超えた分だけを数える（毎フレーム作り直されて前の物と入れ替わる
+# ローカル変数は数えない）。増えた行は前のフレームとの行ごとの差で示す。
+# フレーム内の一時的な確保の最大量と、gc.callbacks で計ったGCの停止時間もそのフレームに結び付けて残す。
+# 記録する側（AllocationTracker のメソッド）自身の確保は数えない。フレームごとの数は前もって確保した配列に書き、
+# 行の内訳は増えたフレームの分だけ残すので、記録が続いても調べるブロックは増えない。
+# 除外は tracemalloc.Filter で書くが、filter_traces はトレース中にフレームごとに fnmatch を呼んで
+# 遅いので、生きているブロックをトレースバックごとにまとめてから、ファイル名の表で判定する。
+# 前のフレームの分はスナップショットではなく、行ごとの数と大きさだけを残す。
+# 別スレッド（フレームキャプチャの書き出しなど）の確保はスタックの根元に threading.py があるので
+# 数えない（根元まで届くよう ALLOC_TRACE_FRAMES 段まで記録する）。一時的な確保の最大量だけは
+# tracemallocがスレッドを区別しないので全スレッドの合計になる。
+GC_TUNED = "tuned"
+GC_DEFAULT = "default"
+GC_IDLE_SPARE = 0.004
+GC_FORCE_PENDING = 50000
+ALLOC_TOP_LINES = 5
+ALLOC_TRACE_FRAMES = 16
+ALLOC_FRAME_CAPACITY = 4096
+
+class GcPolicy:
+    def __init__(self):
+        self.tuned = False
+        self.reason = None
+
+    def enable(self, mode=GC_TUNED):
+        self.tuned = mode == GC_TUNED
+        if self.tuned:
+            gc.disable()
+
+    def disable(self):
+        if self.tuned:
+            gc.unfreeze()
+            gc.enable()
+            self.tuned = False
+
+    def _collect(self, reason, generation=2):
+        self.reason = reason
+        try:
+            gc.collect(generation)
+        finally:
+            self.reason = None
+
+    def after_load(self):
+        if self.tuned:
+            self._collect("load")
+            gc.freeze()
+
+    def transition(self):
+        if self.tuned:
+            self._collect("transition")
+
+    def idle(self, spare):
+        # spare: このフレームの予算の残り（秒）
+        if not self.tuned:
+            return
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        if counts[0] < thresholds[0]:
+            return
+        if spare < GC_IDLE_SPARE and counts[0] < GC_FORCE_PENDING:
+            return
+        generation = 0
+        if counts[1] >= thresholds[1]:
+            generation = 2 if counts[2] >= thresholds[2] else 1
+        self._collect("idle" if spare >= GC_IDLE_SPARE else "forced", generation)
+
+gc_policy = GcPolicy()
+
+class AllocationTracker:
+    def __init__(self):
+        self.enabled = False
+        self.frame = 0
+        # フレームごとの (フレーム番号, 残ったブロック数, バイト数, 一時的な確保の最大量)
+        self.stats = np.zeros((ALLOC_FRAME_CAPACITY, 4), dtype=np.int64)
+        self.count = 0
+        # 残った物があったフレームの、増えた行の上位
+        self.tops = {}
+        self.pauses = []
+        self.gc_start = None
+        self.previous = {}
+        self.base = 0
+        # 記録を始めてから生きているブロックの数とバイト数、その最大
+        self.live = [0, 0]
+        self.high = [0, 0]
+        self.filters = [tracemalloc.Filter(False, tracemalloc.__file__, all_frames=True),
+                        tracemalloc.Filter(False, threading.__file__, all_frames=True)]
+        self.filters += [tracemalloc.Filter(False, __file__, line)
+                         for line in sorted({line for method in (self.enable, self.end_frame, self._on_gc, self._survivors)
+                                             for _, _, line in method.__code__.co_lines() if line})]
+        # ファイル名 -> 除外する行の集合（Noneなら全部）。all_frames の物はどのフレームで当たっても除く
+        self.excluded_lines = {}
+        self.excluded_anywhere = {rule.filename_pattern for rule in self.filters if rule.all_frames}
+        for rule in self.filters:
+            if not rule.all_frames:
+                lines = self.excluded_lines.setdefault(rule.filename_pattern, set())
+                if lines is not None:
+                    if rule.lineno is None:
+                        self.excluded_lines[rule.filename_pattern] = None
+                    else:
+                        lines.add(rule.lineno)
+
+    def enable(self, enabled=True):
+        if enabled and not self.enabled:
+            tracemalloc.start(ALLOC_TRACE_FRAMES)
+            gc.callbacks.append(self._on_gc)
+        elif not enabled and self.enabled:
+            tracemalloc.stop()
+            gc.callbacks.remove(self._on_gc)
+        self.enabled = enabled
+        if enabled:
+            tracemalloc.clear_traces()
+            tracemalloc.reset_peak()
+            self.previous = self._survivors()
+            self.base = tracemalloc.get_traced_memory()[0]
+            self.live = [0, 0]
+            self.high = [0, 0]
+        else:
+            self.previous = {}
+
+    def _on_gc(self, phase, info):
+        if phase == "start":
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            self.pauses.append((self.frame, info["generation"], (time.perf_counter() - self.gc_start) * 1000,
+                                info["collected"], gc_policy.reason or "automatic"))
+            self.gc_start = None
+
+    def _survivors(self):
+        # self.filters に当たらないブロックの、確保した行ごとの [ブロック数, バイト数]
+        # （Traceback は古いフレームから並ぶので、確保した行は最後のフレーム）
+        survivors = {}
+        excluded_lines = self.excluded_lines
+        excluded_anywhere = self.excluded_anywhere
+        for stat in tracemalloc.take_snapshot().statistics("traceback"):
+            frame = stat.traceback[-1]
+            lines = excluded_lines.get(frame.filename, ())
+            if lines is None or frame.lineno in lines:
+                continue
+            if any(other.filename in excluded_anywhere for other in stat.traceback):
+                continue
+            total = survivors.setdefault((frame.filename, frame.lineno), [0, 0])
+            total[0] += stat.count
+            total[1] += stat.size
+        return survivors
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        _, peak = tracemalloc.get_traced_memory()
+        survivors = self._survivors()
+        previous = self.previous
+        differences = []
+        for line in survivors.keys() | previous.keys():
+            count, size = survivors.get(line, (0, 0))
+            old_count, old_size = previous.get(line, (0, 0))
+            if count != old_count or size != old_size:
+                differences.append((line, count - old_count, size - old_size))
+        # 別の行で作り直されて入れ替わる物や、数が揺れる物（画面内の敵のリストなど）があるので、
+        # 生きている量の合計がこれまでの最大を超えた分だけをそのフレームで残った物とみなす
+        self.live[0] += sum(count for _, count, _ in differences)
+        self.live[1] += sum(size for _, _, size in differences)
+        blocks = max(self.live[0] - self.high[0], 0)
+        size = max(self.live[1] - self.high[1], 0)
+        self.high = [max(live, high) for live, high in zip(self.live, self.high)]
+        if blocks or size:
+            grown = sorted((item for item in differences if item[1] > 0), key=lambda item: -item[2])
+            self.tops[self.frame] = [(f"{filename}:{lineno}", count_diff, size_diff)
+                                     for (filename, lineno), count_diff, size_diff in grown[:ALLOC_TOP_LINES]]
+        if self.count == len(self.stats):
+            self.stats = np.concatenate((self.stats, np.zeros_like(self.stats)))
+        self.stats[self.count] = (self.frame, blocks, size, max(peak - self.base, 0))
+        self.count += 1
+        self.frame += 1
+        self.previous = survivors
+        tracemalloc.reset_peak()
+        self.base = tracemalloc.get_traced_memory()[0]
+
+    @property
+    def frames(self):
+        # (フレーム番号, 残ったブロック数, バイト数, 一時的な確保の最大量, 増えた行の上位) のリスト
+        return [(frame, blocks, size, peak, self.tops.get(frame, []))
+                for frame, blocks, size, peak in self.stats[:self.count].tolist()]
+
+    def summary(self):
+        frames = self.frames
+        lines = {}
+        for _, _, _, _, top in frames:
+            for line, count, size in top:
+                total = lines.setdefault(line, [0, 0, 0])
+                total[0] += 1
+                total[1] += count
+                total[2] += size
+        allocating = sum(1 for frame in frames if frame[1] or frame[2])
+        return {
+            "frames": len(frames),
+            "allocating_frames": allocating,
+            "gc_pauses": len(self.pauses),
+            "gc_pause_ms_max": max((pause[2] for pause in self.pauses), default=0.0),
+            "gc_pause_ms_total": sum(pause[2] for pause in self.pauses),
+            "top_lines": sorted(([line] + total for line, total in lines.items()), key=lambda row: -row[2])[:20],
+        }
+
+    def export(self, path):
+        report = {
+            "summary": self.summary(),
+            "frames": [{"frame": frame, "blocks": blocks, "bytes": size, "peak_bytes": peak,
+                        "top": [{"line": line, "blocks": count, "bytes": nbytes} for line, count, nbytes in top]}
+                       for frame, blocks, size, peak, top in self.frames],
+            "gc_pauses": [{"frame": frame, "generation": generation, "ms": ms, "collected": collected,
+                           "reason": reason}
+                          for frame, generation, ms, collected, reason in self.pauses],
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"{summary['allocating_frames']} of {summary['frames']} frames kept allocations; "
+              f"{summary['gc_pauses']} GC pauses (max {summary['gc_pause_ms_max']:.2f} ms, "
+              f"total {summary['gc_pause_ms_total']:.2f} ms)")
+        for line, frames, blocks, size in summary["top_lines"][:10]:
+            print(f"  {line}: {blocks} blocks, {size} bytes in {frames} frames")
+
+allocations = AllocationTracker()
+
+# 内部解像度
+# 画面（ウィンドウ）は論理座標の大きさで一度だけ作り、段階が変わっても作り直さない。
+# 内部解像度を下げる段階では、論理座標の scale 倍のキャンバスに描いてから画面へ一度で拡大する。
+# ScaledCanvas は論理座標で描かれた物をそのキャンバスへ描く。描く画像は初めて使った時に
+# 最近傍で縮小して覚えておく（カラーキーもそのまま使える）。段階が変わる時はキャンバスごと作り直すので、
+# 縮小した画像は新しい大きさで焼き直される。
+# draw_world() からは画面と同じに見えるよう、使うメソッドだけを持つ。
+class ScaledCanvas:
+    def __init__(self, surface, size):
+        self.surface = surface
+        self.size = tuple(size)
+        self.scale = surface.get_width() / size[0]
+        self.sources = weakref.WeakKeyDictionary()
+
+    def _scaled(self, source):
+        scaled = self.sources.get(source)
+        if scaled is None:
+            width, height = source.get_size()
+            size = (max(1, round(width * self.scale)), max(1, round(height * self.scale)))
+            scaled = self.sources[source] = pygame.transform.scale(source, size)
+        return scaled
+
+    def _rect(self, rect):
+        scale = self.scale
+        left = math.floor(rect[0] * scale)
+        top = math.floor(rect[1] * scale)
+        return pygame.Rect(left, top, math.ceil((rect[0] + rect[2]) * scale) - left,
+                           math.ceil((rect[1] + rect[3]) * scale) - top)
+
+    def blit(self, source, dest, area=None, special_flags=0):
+        # 戻り値は論理座標の矩形
+        x, y = dest[0], dest[1]
+        if area is None:
+            width, height = source.get_size()
+            scaled_area = None
+        else:
+            area = pygame.Rect(area)
+            width, height = area.size
+            scaled_area = self._rect(area)
+        scale = self.scale
+        self.surface.blit(self._scaled(source), (math.floor(x * scale), math.floor(y * scale)),
+                          scaled_area, special_flags)
+        return pygame.Rect(x, y, width, height).clip(self.get_rect())
+
+    def blits(self, sequence):
+        return [self.blit(*item) for item in sequence]
+
+    def fill(self, color, rect=None):
+        self.surface.fill(color, None if rect is None else self._rect(pygame.Rect(rect)))
+        return self.get_rect() if rect is None else pygame.Rect(rect)
+
+    def get_size(self):
+        return self.size
+
+    def get_width(self):
+        return self.size[0]
+
+    def get_height(self):
+        return self.size[1]
+
+    def get_rect(self):
+        return pygame.Rect((0, 0), self.size)
+
+    def present(self, display):
+        # キャンバスを画面全体に拡大して写す（flip の前に呼ぶ）
+        pygame.transform.scale(self.surface, display.get_size(), display)
+
+def render_target(display, scale=1.0):
+    # 論理座標で描く先。内部解像度を下げる時は縮めて描くキャンバスを挟む
+    if scale == 1.0:
+        return display
+    size = (round(SCREEN_WIDTH * scale), round(SCREEN_HEIGHT * scale))
+    return ScaledCanvas(_to_display_format(pygame.Surface(size)), (SCREEN_WIDTH, SCREEN_HEIGHT))
+
+# レベルファイル
+# レベルは固定幅のチャンクに分けて保存し、プレイヤーの周りのチャンクだけを読み込む。
+# 書き出し用の小さなレベルはJSONでも書ける。
+# .szl（パック形式）:
+#   ヘッダー  magic, version, プレイヤー初期位置, 幅, 高さ, チャンク幅, チャンク数, コイン数, 敵の数
+#   チャンク表  チャンクごとの (オフセット, 足場数, 敵数, コイン数)
+#   チャンク本体  足場 (id, x, y, w, h, 種類)、敵 (id, x, y)、コイン (id, x, y)
+#   チャンクをまたぐ足場は重なる全チャンクに同じidで入る。
+LEVEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "levels")
+DEFAULT_LEVEL_PATH = os.path.join(LEVEL_DIR, "default.json")
+LEVEL_CHUNK_WIDTH = 512
+LEVEL_MAGIC = b"SZLV"
+LEVEL_VERSION = 1
+LEVEL_HEADER = struct.Struct("<4sHHiiIIIIII")
+LEVEL_CHUNK_ENTRY = struct.Struct("<IHHH2x")
+LEVEL_PLATFORM = struct.Struct("<IiiIIB")
+LEVEL_ENTITY = struct.Struct("<Iii")
+LEVEL_INT_RANGE = (-(1 << 31), (1 << 31) - 1)
+LEVEL_UINT_RANGE = (0, (1 << 32) - 1)
+LEVEL_COUNT_RANGE = (0, (1 << 16) - 1)
+PLATFORM_TYPES = ("ground", "brick", "pipe")
+
+LevelChunk = namedtuple('LevelChunk', ['platforms', 'enemies', 'coins'])
+
+class LevelError(Exception):
+    pass
+
+def _check_level_range(path, what, value, value_range):
+    low, high = value_range
+    if not low <= value <= high:
+        raise LevelError(f"cannot pack level into '{path}': {what} is {value}, "
+                         f"outside the packed format's range {low}..{high}")
+
+class Level:
+    def __init__(self, width, height, player_start, platforms, enemies, coins,
+                 chunk_width=LEVEL_CHUNK_WIDTH):
+        self.width = width
+        self.height = height
+        self.player_start = tuple(player_start)
+        self.chunk_width = chunk_width
+        self.chunk_count = max(1, -(-width // chunk_width))
+        self.coin_count = len(coins)
+        self.enemy_count = len(enemies)
+        self.chunks = [LevelChunk([], [], []) for _ in range(self.chunk_count)]
+        for record_id, (x, y, w, h, platform_type) in enumerate(platforms):
+            if platform_type not in PLATFORM_TYPES:
+                raise LevelError(f"platform {record_id} has unknown type '{platform_type}'")
+            for index in range(self.chunk_index(x), self.chunk_index(x + w - 1) + 1):
+                self.chunks[index].platforms.append((record_id, x, y, w, h, platform_type))
+        for record_id, (x, y) in enumerate(enemies):
+            self.chunks[self.chunk_index(x)].enemies.append((record_id, x, y))
+        for record_id, (x, y) in enumerate(coins):
+            self.chunks[self.chunk_index(x)].coins.append((record_id, x, y))
+
+    def chunk_index(self, x):
+        return min(max(int(x) // self.chunk_width, 0), self.chunk_count - 1)
+
+    def read_chunk(self, index):
+        return self.chunks[index]
+
+    def close(self):
+        pass
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        try:
+            return cls(data["width"], data.get("height", SCREEN_HEIGHT), data["player"],
+                       [tuple(p) for p in data["platforms"]],
+                       [tuple(e) for e in data.get("enemies", [])],
+                       [tuple(c) for c in data.get("coins", [])],
+                       data.get("chunk_width", LEVEL_CHUNK_WIDTH))
+        except (KeyError, TypeError, ValueError, LevelError) as e:
+            raise LevelError(f"invalid level file '{path}': {e}") from e
+
+    def _check_ranges(self, path):
+        for what, value, value_range in (
+                ("player x", self.player_start[0], LEVEL_INT_RANGE),
+                ("player y", self.player_start[1], LEVEL_INT_RANGE),
+                ("level width", self.width, LEVEL_UINT_RANGE),
+                ("level height", self.height, LEVEL_UINT_RANGE),
+                ("chunk width", self.chunk_width, LEVEL_UINT_RANGE)):
+            _check_level_range(path, what, value, value_range)
+        for index, chunk in enumerate(self.chunks):
+            for kind, records in (("platforms", chunk.platforms), ("enemies", chunk.enemies),
+                                  ("coins", chunk.coins)):
+                _check_level_range(path, f"the number of {kind} in chunk {index}", len(records), LEVEL_COUNT_RANGE)
+            for record_id, x, y, w, h, platform_type in chunk.platforms:
+                _check_level_range(path, f"platform {record_id} x", x, LEVEL_INT_RANGE)
+                _check_level_range(path, f"platform {record_id} y", y, LEVEL_INT_RANGE)
+                _check_level_range(path, f"platform {record_id} width", w, LEVEL_UINT_RANGE)
+                _check_level_range(path, f"platform {record_id} height", h, LEVEL_UINT_RANGE)
+            for kind, records in (("enemy", chunk.enemies), ("coin", chunk.coins)):
+                for record_id, x, y in records:
+                    _check_level_range(path, f"{kind} {record_id} x", x, LEVEL_INT_RANGE)
+                    _check_level_range(path, f"{kind} {record_id} y", y, LEVEL_INT_RANGE)
+
+    def save(self, path):
+        self._check_ranges(path)
+        header_size = LEVEL_HEADER.size + LEVEL_CHUNK_ENTRY.size * self.chunk_count
+        table = []
+        bodies = []
+        offset = header_size
+        for chunk in self.chunks:
+            body = b"".join(
+                [LEVEL_PLATFORM.pack(record_id, x, y, w, h, PLATFORM_TYPES.index(platform_type))
+                 for record_id, x, y, w, h, platform_type in chunk.platforms] +
+                [LEVEL_ENTITY.pack(*record) for record in chunk.enemies] +
+                [LEVEL_ENTITY.pack(*record) for record in chunk.coins])
+            table.append(LEVEL_CHUNK_ENTRY.pack(offset, len(chunk.platforms), len(chunk.enemies), len(chunk.coins)))
+            bodies.append(body)
+            offset += len(body)
+            _check_level_range(path, "the packed file size", offset, LEVEL_UINT_RANGE)
+        with open(path, "wb") as f:
+            f.write(LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, 0,
+                                      self.player_start[0], self.player_start[1],
+                                      self.width, self.height, self.chunk_width, self.chunk_count,
+                                      self.coin_count, self.enemy_count))
+            f.write(b"".join(table))
+            for body in bodies:
+                f.write(body)
+
+class LevelFile:
+    # パック形式のレベルをディスクから1チャンクずつ読む
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        header = self.file.read(LEVEL_HEADER.size)
+        if len(header) != LEVEL_HEADER.size:
+            self.file.close()
+            raise LevelError(f"invalid level file '{path}': truncated header")
+        (magic, version, _, start_x, start_y, self.width, self.height, self.chunk_width,
+         self.chunk_count, self.coin_count, self.enemy_count) = LEVEL_HEADER.unpack(header)
+        if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+            self.file.close()
+            raise LevelError(f"invalid level file '{path}': bad magic or version")
+        self.player_start = (start_x, start_y)
+        table = self.file.read(LEVEL_CHUNK_ENTRY.size * self.chunk_count)
+        if not self.chunk_count or len(table) != LEVEL_CHUNK_ENTRY.size * self.chunk_count:
+            self.file.close()
+            raise LevelError(f"invalid level file '{path}': truncated chunk table")
+        self.table = list(LEVEL_CHUNK_ENTRY.iter_unpack(table))
+
+    def chunk_index(self, x):
+        return min(max(int(x) // self.chunk_width, 0), self.chunk_count - 1)
+
+    def read_chunk(self, index):
+        offset, platform_count, enemy_count, coin_count = self.table[index]
+        self.file.seek(offset)
+        size = LEVEL_PLATFORM.size * platform_count + LEVEL_ENTITY.size * (enemy_count + coin_count)
+        data = self.file.read(size)
+        if len(data) != size:
+            self.file.close()
+            raise LevelError(f"invalid level file '{self.path}': truncated chunk {index}")
+        try:
+            platforms = [(record_id, x, y, w, h, PLATFORM_TYPES[platform_type])
+                         for record_id, x, y, w, h, platform_type
+                         in LEVEL_PLATFORM.iter_unpack(data[:LEVEL_PLATFORM.size * platform_count])]
+        except IndexError:
+            self.file.close()
+            raise LevelError(f"invalid level file '{self.path}': unknown platform type in chunk {index}") from None
+        entities = list(LEVEL_ENTITY.iter_unpack(data[LEVEL_PLATFORM.size * platform_count:]))
+        return LevelChunk(platforms, entities[:enemy_count], entities[enemy_count:])
+
+    def close(self):
+        self.file.close()
+
+def load_level(path=DEFAULT_LEVEL_PATH):
+    # 読めないファイルや壊れたファイルは全部 LevelError にする
+    try:
+        if path.lower().endswith(".json"):
+            return Level.from_json(path)
+        return LevelFile(path)
+    except OSError as e:
+        raise LevelError(f"cannot read level file '{path}': {e.strerror or e}") from e
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise LevelError(f"invalid level file '{path}': {e}") from e
+
+def generate_level(screens, seed=0, chunk_width=LEVEL_CHUNK_WIDTH):
+    # 性能試験用の長いレベルを作る
+    rng = random.Random(seed)
+    ground_y = SCREEN_HEIGHT - 60
+    platforms = []
+    enemies = []
+    coins = []
+    for screen_index in range(screens):
+        left = screen_index * SCREEN_WIDTH
+        platforms.append((left, ground_y, SCREEN_WIDTH, 60, "ground"))
+        for _ in range(3):
+            x = left + rng.randrange(100, SCREEN_WIDTH - 250, 10)
+            height = rng.choice((100, 200, 300))
+            platforms.append((x, ground_y - height, 150, 20, "brick"))
+            coins.append((x + 50, ground_y - height - 40))
+            if screen_index and rng.random() < 0.5:
+                enemies.append((x + 50, ground_y - height - 35))
+        # 最初の画面はスタート地点なので土管と敵を置かない
+        if screen_index:
+            pipe_height = rng.choice((100, 150))
+            pipe_x = left + rng.randrange(100, SCREEN_WIDTH - 160, 10)
+            platforms.append((pipe_x, ground_y - pipe_height, 60, pipe_height, "pipe"))
+            enemies.append((left + rng.randrange(100, SCREEN_WIDTH - 100, 10), ground_y - 35))
+    return Level(screens * SCREEN_WIDTH, SCREEN_HEIGHT, (100, 400), platforms, enemies, coins,
+                 chunk_width)
+
+# ワールド
+# 描画・イベント・時計に依存しないシミュレーション本体。
+# step(inputs) で1フレーム進め、その結果の状態を返す。
+# プレイヤーの周りのチャンクだけを読み込み、離れたチャンクは破棄する。
+WorldState = namedtuple('WorldState', [
+    'frame', 'player_x', 'player_y', 'vel_x', 'vel_y', 'on_ground',
+    'coins_collected', 'enemies_left', 'game_over', 'won'])
+
+# カメラ
+# 画面より広いワールドをスクロールして見せる。描画は見えている範囲だけに絞り、
+# 見える範囲の周りの「活動範囲」の外にいる敵やコインは眠らせる。
+ACTIVE_MARGIN = 256
+CULL_MARGIN = 32
+
+class Camera:
+    def __init__(self, view_width, view_height, world_width, world_height):
+        self.view = pygame.Rect(0, 0, view_width, view_height)
+        self.world_width = world_width
+        self.world_height = world_height
+        self.active = self.view.inflate(ACTIVE_MARGIN * 2, ACTIVE_MARGIN * 2)
+        self.cull = self.view.inflate(CULL_MARGIN * 2, CULL_MARGIN * 2)
+        self.previous_offset = self.view.topleft
+
+    @property
+    def offset(self):
+        return self.view.topleft
+
+    def remember(self):
+        self.previous_offset = self.view.topleft
+
+    def interpolated_offset(self, alpha):
+        if alpha >= 1:
+            return self.view.topleft
+        (px, py), (x, y) = self.previous_offset, self.view.topleft
+        return (px + round((x - px) * alpha), py + round((y - py) * alpha))
+
+    def follow(self, rect):
+        x = min(max(rect.centerx - self.view.width // 2, 0), max(self.world_width - self.view.width, 0))
+        y = min(max(rect.centery - self.view.height // 2, 0), max(self.world_height - self.view.height, 0))
+        self.move_to(x, y)
+
+    def move_to(self, x, y):
+        self.view.topleft = (x, y)
+        self.active.center = self.view.center
+        self.cull.center = self.view.center
+
+    def is_visible(self, rect):
+        return self.cull.colliderect(rect)
+
+class LoadedChunk:
+    def __init__(self, index, data):
+        self.index = index
+        self.data = data
+        self.platform_ids = [record[0] for record in data.platforms]
+        # (level_id, ハンドル)。読み込んだ時に倒されていた・取られていたものはハンドルがNone
+        self.enemies = []
+        self.coins = []
+
+    def spawn(self, enemies, coins, killed=(), collected=()):
+        self.enemies = [(record_id, None if record_id in killed else enemies.spawn(x, y, record_id))
+                        for record_id, x, y in self.data.enemies]
+        self.coins = [(record_id, None if record_id in collected else coins.spawn(x, y, record_id))
+                      for record_id, x, y in self.data.coins]
+
+class World:
+    def __init__(self, level=None, stream_radius=SCREEN_WIDTH, seed=0):
+        self.level = level if level is not None else load_level()
+        # 乱数はワールドごとに持ち、同じシードと入力なら同じ結果になるようにする
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.effects_rng = random.Random(seed + 1)
+        self.width = self.level.width
+        self.height = self.level.height
+        self.coin_count = self.level.coin_count
+        self.stream_radius = stream_radius
+        self.grid = PlatformGrid()
+        self.ground = GroundIndex(floor=self.height)
+        self.platforms = []
+        self.platform_refs = {}
+        self.platforms_version = 0
+        self.loaded = {}
+        self.loaded_range = None
+        self.enemies = EnemyStore()
+        self.coins = CoinStore()
+        self.loaded_coin_count = 0
+        self.collected = set()
+        self.killed = set()
+        self.sparkles = ParticleSystem(4096, render_sparkle)
+        self.player = Player(*self.level.player_start, rng=self.rng)
+        self.camera = Camera(SCREEN_WIDTH, SCREEN_HEIGHT, self.width, self.height)
+        self.reset()
+
+    def reset(self):
+        # 読み込み済みのチャンクはそのまま使い、敵とコインだけを出現位置に置き直す
+        self.collected.clear()
+        self.killed.clear()
+        self.player.reset(*self.level.player_start)
+        self.enemies.clear()
+        self.coins.clear()
+        for chunk in self.loaded.values():
+            chunk.spawn(self.enemies, self.coins)
+        self.loaded_coin_count = len(self.coins)
+        self.sparkles.clear()
+        self.frame = 0
+        self.game_over = False
+        self.loaded_range = None
+        self.camera.follow(self.player.rect)
+        self.stream()
+        self.remember()
+
+    def remember(self):
+        # 次のステップの前の位置を覚えておき、描画はその間を補間する
+        self.player.remember()
+        self.enemies.remember()
+        self.camera.remember()
+
+    def stream(self):
+        x = self.player.rect.centerx
+        level = self.level
+        wanted = (level.chunk_index(x - self.stream_radius), level.chunk_index(x + self.stream_radius))
+        if wanted == self.loaded_range:
+            return
+        self.loaded_range = wanted
+        # 少し離れるまでは破棄しない
+        keep = (level.chunk_index(x - self.stream_radius - level.chunk_width),
+                level.chunk_index(x + self.stream_radius + level.chunk_width))
+        for index in [i for i in self.loaded if not keep[0] <= i <= keep[1]]:
+            self.unload_chunk(index)
+        for index in range(wanted[0], wanted[1] + 1):
+            if index not in self.loaded:
+                self.load_chunk(index)
+
+    def load_chunk(self, index):
+        chunk = self.loaded[index] = LoadedChunk(index, self.level.read_chunk(index))
+        for record_id, x, y, w, h, platform_type in chunk.data.platforms:
+            ref = self.platform_refs.get(record_id)
+            if ref is None:
+                platform = Platform(x, y, w, h, platform_type)
+                ref = self.platform_refs[record_id] = [platform, 0]
+                self.grid.add(record_id, platform)
+            ref[1] += 1
+        coins_before = len(self.coins)
+        chunk.spawn(self.enemies, self.coins, self.killed, self.collected)
+        self.loaded_coin_count += len(self.coins) - coins_before
+        self._platforms_changed()
+
+    def unload_chunk(self, index):
+        chunk = self.loaded.pop(index)
+        for record_id in chunk.platform_ids:
+            ref = self.platform_refs[record_id]
+            ref[1] -= 1
+            if ref[1] == 0:
+                del self.platform_refs[record_id]
+                self.grid.remove(record_id)
+        # ストアから消えているものは倒された敵・取られたコインとして覚えておく
+        for record_id, handle in chunk.enemies:
+            if handle is not None and not self.enemies.remove(handle):
+                self.killed.add(record_id)
+        for record_id, handle in chunk.coins:
+            if handle is not None:
+                if not self.coins.remove(handle):
+                    self.collected.add(record_id)
+                self.loaded_coin_count -= 1
+        self._platforms_changed()
+
+    def _platforms_changed(self):
+        self.platforms[:] = [self.grid.platforms[key] for key in sorted(self.grid.platforms)]
+        self.platforms_version += 1
+        self.ground.set_platforms(self.platforms)
+        self.enemies.set_platforms(self.platforms)
+
+    @property
+    def coins_collected(self):
+        return len(self.collected) + self.loaded_coin_count - len(self.coins)
+
+    @property
+    def won(self):
+        return not self.game_over and self.coins_collected == self.coin_count
+
+    def step(self, inputs=NO_INPUT):
+        if inputs.restart and self.game_over:
+            self.reset()
+        self.remember()
+        if not self.game_over:
+            if not self.player.update(inputs, self.grid, self.enemies, self.coins, self.width):
+                self.game_over = True
+            profiler.mark(PHASE_PLAYER)
+            # 活動範囲の外の敵は眠らせて動かさない
+            self.enemies.update(self.camera.active, self.width)
+            profiler.mark(PHASE_ENEMIES)
+            self.frame += 1
+            self.camera.follow(self.player.rect)
+            self.stream()
+            profiler.mark(PHASE_STREAMING)
+        return self.state()
+
+    def state_hash(self):
+        # 再生時の照合に使う、シミュレーション状態のハッシュ
+        player = self.player
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(struct.pack("<qddddd??ii", self.frame, player.x, player.y,
+                                  player.vel_x, player.vel_y, player.rect.y, player.on_ground,
+                                  self.game_over, self.coins_collected, len(self.enemies)))
+        digest.update(self.enemies.state_bytes())
+        return digest.digest()
+
+    def state(self):
+        player = self.player
+        return WorldState(self.frame, player.x, player.y, player.vel_x, player.vel_y,
+                          player.on_ground, self.coins_collected, len(self.enemies),
+                          self.game_over, self.won)
+
+def run_headless(steps, policy=None, world=None):
+    # policy(world) -> Inputs。ゲームオーバーになったらリセットして続ける
+    world = world if world is not None else World()
+    for _ in range(steps):
+        if world.game_over:
+            world.reset()
+        world.step(policy(world) if policy else NO_INPUT)
+    return world
+
+# 入力の記録と再生
+# 毎フレームの入力ビットマスクをランレングス圧縮して記録し、一定間隔で状態ハッシュも残す。
+# 再生はウィンドウなしで最高速度で行い、チェックポイントでハッシュを照合する。
+# .szr:
+#   ヘッダー  magic, version, シード, チェックポイント間隔, レベルパスの長さ, レベルパス(UTF-8),
+#             レベルファイルのハッシュ(8バイト)
+#   レコード  0x01 マスク 連続フレーム数(varint) / 0x02 フレーム番号(varint) ハッシュ(8バイト)
+#   終わり    0x03 全フレーム数(varint) 最後の状態のハッシュ(8バイト)。これが無いファイルは途中で切れている
+# レベルパスは LEVEL_DIR の中なら LEVEL_DIR からの相対パス（区切りは "/"）で残すので、
+# 別の場所に置いたチェックアウトでも同じレベルを見つけられる。
+REPLAY_MAGIC = b"SZRP"
+REPLAY_VERSION = 2
+REPLAY_HEADER = struct.Struct("<4sHqIH")
+REPLAY_LEVEL_DIGEST_SIZE = 8
+REPLAY_RUN = 1
+REPLAY_CHECKPOINT = 2
+REPLAY_END = 3
+REPLAY_CHECKPOINT_INTERVAL = 60
+
+class ReplayError(Exception):
+    pass
+
+class ReplayMismatch(ReplayError):
+    def __init__(self, frame, expected, actual):
+        super().__init__(f"state hash mismatch at frame {frame}: expected {expected.hex()}, got {actual.hex()}")
+        self.frame = frame
+        self.expected = expected
+        self.actual = actual
+
+def level_digest(path):
+    digest = hashlib.blake2b(digest_size=REPLAY_LEVEL_DIGEST_SIZE)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.digest()
+
+def _replay_level_name(path):
+    path = os.path.abspath(path)
+    try:
+        inside = os.path.commonpath((path, LEVEL_DIR)) == LEVEL_DIR
+    except ValueError:
+        # Windowsでドライブが違う
+        inside = False
+    if not inside:
+        return path
+    return os.path.relpath(path, LEVEL_DIR).replace(os.sep, "/")
+
+def _replay_level_path(name):
+    if os.path.isabs(name):
+        return name
+    return os.path.join(LEVEL_DIR, *name.split("/"))
+
+def _write_varint(f, value):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            f.write(bytes((byte | 0x80,)))
+        else:
+            f.write(bytes((byte,)))
+            return
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ReplayError("truncated replay")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+class InputRecorder:
+    def __init__(self, path, seed, level_path=DEFAULT_LEVEL_PATH,
+                 checkpoint_interval=REPLAY_CHECKPOINT_INTERVAL):
+        self.file = open(path, "wb")
+        self.checkpoint_interval = checkpoint_interval
+        level = _replay_level_name(level_path).encode("utf-8")
+        self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, seed, checkpoint_interval, len(level)))
+        self.file.write(level)
+        self.file.write(level_digest(level_path))
+        self.frames = 0
+        self.bits = None
+        self.run = 0
+
+    def _flush_run(self):
+        if self.run:
+            self.file.write(bytes((REPLAY_RUN, self.bits)))
+            _write_varint(self.file, self.run)
+            self.run = 0
+
+    def record(self, inputs, world):
+        # world.step(inputs) の直後に呼ぶ
+        bits = inputs.to_bits()
+        if bits != self.bits:
+            self._flush_run()
+            self.bits = bits
+        self.run += 1
+        self.frames += 1
+        if self.checkpoint_interval and self.frames % self.checkpoint_interval == 0:
+            self._flush_run()
+            self.file.write(bytes((REPLAY_CHECKPOINT,)))
+            _write_varint(self.file, self.frames)
+            self.file.write(world.state_hash())
+
+    def close(self, world):
+        # 終わりのレコードに最後の状態を残す
+        try:
+            self._flush_run()
+            self.file.write(bytes((REPLAY_END,)))
+            _write_varint(self.file, self.frames)
+            self.file.write(world.state_hash())
+        finally:
+            self.file.close()
+
+ReplayResult = namedtuple('ReplayResult', ['frames', 'checkpoints', 'elapsed', 'state'])
+
+def read_replay(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < REPLAY_HEADER.size:
+        raise ReplayError(f"invalid replay file '{path}': truncated header")
+    magic, version, seed, checkpoint_interval, level_length = REPLAY_HEADER.unpack_from(data)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ReplayError(f"invalid replay file '{path}': bad magic or version")
+    pos = REPLAY_HEADER.size
+    if len(data) < pos + level_length + REPLAY_LEVEL_DIGEST_SIZE:
+        raise ReplayError("truncated replay")
+    try:
+        level_path = _replay_level_path(data[pos:pos + level_length].decode("utf-8"))
+    except UnicodeDecodeError:
+        raise ReplayError(f"invalid replay file '{path}': bad level path") from None
+    pos += level_length
+    digest = data[pos:pos + REPLAY_LEVEL_DIGEST_SIZE]
+    pos += REPLAY_LEVEL_DIGEST_SIZE
+    return seed, level_path, digest, data, pos
+
+def run_replay(path, level_path=None, verify=True, capture=None):
+    # level_path を渡すと記録されたレベルの代わりに使う（中身は記録と同じでなければならない）
+    # capture を渡すと、毎フレームをゲームと同じように描いて書き出す
+    seed, recorded_level, recorded_digest, data, pos = read_replay(path)
+    level_path = level_path or recorded_level
+    try:
+        digest = level_digest(level_path)
+    except OSError as e:
+        raise ReplayError(f"level '{level_path}' for replay '{path}' cannot be read ({e.strerror}); "
+                          f"pass the recorded level with --level") from e
+    if digest != recorded_digest:
+        raise ReplayError(f"level '{level_path}' does not match the level replay '{path}' was recorded on")
+    world = World(load_level(level_path), seed=seed)
+    frame_count = 0
+    frames = 0
+    checkpoints = 0
+    start_time = time.perf_counter()
+    try:
+        while True:
+            if pos >= len(data):
+                raise ReplayError(f"truncated replay '{path}': missing end record")
+            tag = data[pos]
+            if tag == REPLAY_RUN:
+                if pos + 1 >= len(data):
+                    raise ReplayError("truncated replay")
+                inputs = Inputs.from_bits(data[pos + 1])
+                run, pos = _read_varint(data, pos + 2)
+                step = world.step
+                if capture:
+                    for _ in range(run):
+                        # main() と同じく、リスタートでアニメーションのフレーム番号も0に戻す
+                        if inputs.restart and world.game_over:
+                            frame_count = 0
+                        step(inputs)
+                        frame_count += 1
+                        draw_world(screen, world, frame_count)
+                        draw_hud(screen, world)
+                        capture.capture(screen)
+                else:
+                    for _ in range(run):
+                        step(inputs)
+                frames += run
+            elif tag == REPLAY_CHECKPOINT:
+                frame, pos = _read_varint(data, pos + 1)
+                expected = data[pos:pos + 8]
+                if len(expected) < 8:
+                    # 途中で切れたハッシュは不一致ではなく壊れたファイル
+                    raise ReplayError("truncated replay")
+                pos += 8
+                if verify and frame == frames:
+                    actual = world.state_hash()
+                    if actual != expected:
+                        raise ReplayMismatch(frame, expected, actual)
+                    checkpoints += 1
+            elif tag == REPLAY_END:
+                frame, pos = _read_varint(data, pos + 1)
+                expected = data[pos:pos + 8]
+                if len(expected) < 8:
+                    raise ReplayError("truncated replay")
+                pos += 8
+                if frame != frames or pos != len(data):
+                    raise ReplayError(f"invalid replay file '{path}': end record does not match the recorded frames")
+                if verify:
+                    actual = world.state_hash()
+                    if actual != expected:
+                        raise ReplayMismatch(frame, expected, actual)
+                break
+            else:
+                raise ReplayError(f"invalid replay file '{path}': unknown record {tag} at byte {pos}")
+    finally:
+        world.level.close()
+    return ReplayResult(frames, checkpoints, time.perf_counter() - start_time, world.state())
+
+# フレームキャプチャ
+# flip() の直後に画面の画素を使い回しのバッファへコピーするだけにして、色変換・圧縮・書き出しは
+# 書き出しスレッドで行う（NumPyとzlibはGILを手放すので、ゲームのフレームはほとんど遅れない）。
+# 書き出しが追いつかずにバッファが尽きた時の扱いは drop ポリシーで選ぶ:
+#   block        空くまで待つ（再生からの書き出しなど、1フレームも落とせない時）
+#   drop-newest  今のフレームを捨てる
+#   drop-oldest  まだ書いていない一番古いフレームを捨てて今のフレームを入れる
+# 出力はパスで決まる: .y4m（YUV4MPEG2 4:2:0）、.raw（rgb24を連結）、それ以外はPNG連番
+# （"%06d" などを含むパターンか、ディレクトリ）。ストリームではフレームを落とした所に
+# 直前のフレームを繰り返して書き、時間がずれないようにする。
+CAPTURE_BLOCK = "block"
+CAPTURE_DROP_NEWEST = "drop-newest"
+CAPTURE_DROP_OLDEST = "drop-oldest"
+CAPTURE_DROP_POLICIES = (CAPTURE_BLOCK, CAPTURE_DROP_NEWEST, CAPTURE_DROP_OLDEST)
+CAPTURE_POOL_SIZE = 8
+CAPTURE_PNG_PATTERN = "frame_%06d.png"
+CAPTURE_PNG_LEVEL = 1
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# RGBからYUVへの係数（BT.601フルレンジ）を整数にしたもの。輝度は 1 << 8 倍で16ビットに収め、
+# 色差は 1 << 16 倍。どの行も足すと 1 << 8（輝度）か0（色差）になる
+YUV_Y = (77, 150, 29)
+YUV_CB = (-11059, -21709, 32768)
+YUV_CR = (32768, -27439, -5329)
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)))
+
+class FrameCapture:
+    def __init__(self, path, drop=CAPTURE_DROP_NEWEST, pool_size=CAPTURE_POOL_SIZE, fps=FPS):
+        if drop not in CAPTURE_DROP_POLICIES:
+            raise ValueError(f"unknown drop policy '{drop}'")
+        self.path = path
+        self.drop = drop
+        self.pool_size = pool_size
+        self.fps = fps
+        lower = path.lower()
+        if lower.endswith(".y4m"):
+            self.format = "y4m"
+        elif lower.endswith((".raw", ".rgb")):
+            self.format = "raw"
+        else:
+            self.format = "png"
+            if "%" not in path:
+                path = os.path.join(path, CAPTURE_PNG_PATTERN)
+            self.pattern = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = None if self.format == "png" else open(path, "wb")
+        self.size = None
+        self.free = queue.Queue()
+        self.pending = queue.Queue()
+        self.frames = 0
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+        self.thread = None
+
+    def _start(self, surface):
+        # 最初のフレームで画面の形式に合わせたバッファを用意する
+        self.size = surface.get_size()
+        width, height = self.size
+        if surface.get_bytesize() == 4:
+            # 32ビットの画面は pixels2d の転置がそのまま行優先の画素になる
+            self.channels = [shift // 8 for shift in surface.get_shifts()[:3]]
+            shape = (height, width)
+            dtype = np.uint32
+        else:
+            self.channels = None
+            shape = (height, width, 3)
+            dtype = np.uint8
+        for _ in range(self.pool_size):
+            self.free.put(np.empty(shape, dtype))
+        if self.format == "png":
+            # 各行の先頭にフィルター種別（0 = なし）を置いた、そのままzlibに渡せる形
+            self.rows = np.zeros((height, 1 + width * 3), np.uint8)
+            self.rgb = self.rows[:, 1:].reshape(height, width, 3)
+            self.png_header = PNG_SIGNATURE + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        elif self.format == "y4m":
+            self.file.write(f"YUV4MPEG2 W{width} H{height} F{self.fps}:1 Ip A1:1 C420jpeg\n".encode("ascii"))
+            half_width = (width + 1) // 2
+            half_height = (height + 1) // 2
+            self.yuv = np.empty(width * height + 2 * half_width * half_height, np.uint8)
+            # 変換の途中のバッファ。色を平面に分け、奇数の幅・高さは端の画素を繰り返して偶数にする
+            self.planes = np.empty((3, half_height * 2, half_width * 2), np.uint8)
+            self.luma = np.empty((height, width), np.uint16)
+            self.term = np.empty((height, width), np.uint16)
+            self.pairs = np.empty((3, half_height, half_width * 2), np.uint16)
+            self.quads = np.empty((3, half_height, half_width), np.uint16)
+            self.chroma = np.empty((2, half_height, half_width), np.int32)
+            self.chroma_term = np.empty((half_height, half_width), np.int32)
+        else:
+            self.rgb = np.empty((height, width, 3), np.uint8)
+        self.last = None
+        self.thread = threading.Thread(target=self._write_loop, name="FrameCapture", daemon=True)
+        self.thread.start()
+
+    def capture(self, surface):
+        # 描画し終えた画面を預ける。フレームを落とした時は False を返す
+        if self.size is None:
+            self._start(surface)
+        elif surface.get_size() != self.size:
+            raise ValueError(f"frame size changed from {self.size} to {surface.get_size()}")
+        if self.error:
+            raise self.error
+        index = self.frames
+        self.frames += 1
+        try:
+            buffer = self.free.get_nowait()
+        except queue.Empty:
+            if self.drop == CAPTURE_BLOCK:
+                buffer = self.free.get()
+            elif self.drop == CAPTURE_DROP_OLDEST:
+                try:
+                    _, buffer = self.pending.get_nowait()
+                except queue.Empty:
+                    self.dropped += 1
+                    return False
+                self.dropped += 1
+            else:
+                self.dropped += 1
+                return False
+        if self.channels is None:
+            np.copyto(buffer, pygame.surfarray.pixels3d(surface).transpose(1, 0, 2))
+        else:
+            np.copyto(buffer, pygame.surfarray.pixels2d(surface).T)
+        self.pending.put((index, buffer))
+        return True
+
+    def _to_rgb(self, buffer):
+        rgb = self.rgb
+        if self.channels is None:
+            np.copyto(rgb, buffer)
+        else:
+            pixels = buffer.view(np.uint8).reshape(buffer.shape + (4,))
+            for i, channel in enumerate(self.channels):
+                rgb[..., i] = pixels[..., channel]
+        return rgb
+
+    def _to_yuv(self, buffer):
+        # JPEGと同じフルレンジのBT.601を、係数を整数にした固定小数点で計算する。
+        # 色差は2x2の合計（平均の4倍）から作るので、色差の計算は画素数の1/4で済む
+        width, height = self.size
+        if self.channels is None:
+            pixels, channels = buffer, (0, 1, 2)
+        else:
+            pixels, channels = buffer.view(np.uint8).reshape(buffer.shape + (4,)), self.channels
+        planes = self.planes
+        for plane, channel in zip(planes, channels):
+            np.copyto(plane[:height, :width], pixels[..., channel])
+        if height % 2:
+            planes[:, height] = planes[:, height - 1]
+        if width % 2:
+            planes[:, :, width] = planes[:, :, width - 1]
+        red, green, blue = planes[:, :height, :width]
+        luma = self.luma
+        term = self.term
+        np.multiply(red, YUV_Y[0], out=luma, dtype=np.uint16)
+        np.multiply(green, YUV_Y[1], out=term, dtype=np.uint16)
+        luma += term
+        np.multiply(blue, YUV_Y[2], out=term, dtype=np.uint16)
+        luma += term
+        luma += 1 << 7
+        luma >>= 8
+        np.copyto(self.yuv[:width * height].reshape(height, width), luma, casting="unsafe")
+
+        pairs = self.pairs
+        quads = self.quads
+        np.add(planes[:, 0::2], planes[:, 1::2], out=pairs, dtype=np.uint16)
+        np.add(pairs[:, :, 0::2], pairs[:, :, 1::2], out=quads)
+        term = self.chroma_term
+        for chroma, weights in zip(self.chroma, (YUV_CB, YUV_CR)):
+            np.multiply(quads[0], weights[0], out=chroma, dtype=np.int32)
+            for quad, weight in zip(quads[1:], weights[1:]):
+                np.multiply(quad, weight, out=term, dtype=np.int32)
+                chroma += term
+            chroma += (128 << 18) + (1 << 17)
+            chroma >>= 18
+        np.clip(self.chroma, 0, 255, out=self.chroma)
+        np.copyto(self.yuv[width * height:].reshape(self.chroma.shape), self.chroma, casting="unsafe")
+        return self.yuv
+
+    def _encode(self, index, buffer):
+        if self.format == "png":
+            self._to_rgb(buffer)
+            data = (self.png_header + _png_chunk(b"IDAT", zlib.compress(self.rows, CAPTURE_PNG_LEVEL))
+                    + _png_chunk(b"IEND", b""))
+            with open(self.pattern % index, "wb") as f:
+                f.write(data)
+            return
+        if self.last is not None:
+            # 落としたフレームの分だけ直前のフレームを繰り返す（変換先のバッファはまだ直前のフレーム）
+            for _ in range(index - self.last - 1):
+                self._write_frame(self.yuv if self.format == "y4m" else self.rgb)
+        self._write_frame(self._to_yuv(buffer) if self.format == "y4m" else self._to_rgb(buffer))
+        self.last = index
+
+    def _write_frame(self, frame):
+        if self.format == "y4m":
+            self.file.write(b"FRAME\n")
+        self.file.write(frame.data)
+
+    def _write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            index, buffer = item
+            try:
+                if self.error is None:
+                    self._encode(index, buffer)
+                    self.written += 1
+            except Exception as e:
+                self.error = e
+            finally:
+                self.free.put(buffer)
+
+    def close(self):
+        # 預かったフレームを全て書き終えるまで待つ
+        if self.thread:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.error:
+            raise self.error
+
+    def summary(self):
+        return f"captured {self.written} frames ({self.dropped} dropped) to {self.path}"
+
+def _discard(rect):
+    pass
+
+def draw_world(screen, world, frame_count, renderer=None, alpha=1.0, steps=1):
+    # カメラに映る範囲だけを描く。活動範囲の外のコインはアニメーションも止める
+    # alpha は前のステップと今のステップの間の補間位置、steps は前回の描画から進んだステップ数
+    camera = world.camera
+    offset = camera.interpolated_offset(alpha)
+    visible_platforms = [p for p in world.platforms if camera.is_visible(p.rect)]
+    scene_key = (world.platforms_version, offset)
+    if renderer and renderer.scene_key != scene_key and renderer.scrolling(scene_key):
+        renderer = None
+    if renderer:
+        if renderer.scene_key != scene_key:
+            renderer.set_scene(lambda surface, backdrop: draw_static_scene(surface, visible_platforms, offset, backdrop),
+                               scene_key)
+        renderer.begin()
+        add = renderer.add
+    else:
+        draw_background(screen, offset[0])
+        add = _discard
+    mark = profiler.mark
+    mark(PHASE_BACKGROUND)
     
-    enemies = [
-        Enemy(300, SCREEN_HEIGHT - 60 - 35),
-        Enemy(500, SCREEN_HEIGHT - 60 - 300 - 35),
-        Enemy(750, SCREEN_HEIGHT - 60 - 35),
-    ]
+    if renderer:
+        # 足場は静的シーンにあるので、草の揺れのコマが変わった時だけ草の帯を描き直して送る
+        grass_frame = PlatformArt.frame_index(frame_count)
+        if renderer.grass_frame != grass_frame:
+            renderer.grass_frame = grass_frame
+            for platform in visible_platforms:
+                if platform.art.frames:
+                    rect = platform.draw(renderer.static, offset, frame_count, renderer.backdrop)
+                    screen.blit(renderer.static, rect, rect)
+                    add(rect)
+    else:
+        for platform in visible_platforms:
+            platform.draw(screen, offset, frame_count)
+    mark(PHASE_PLATFORMS)
+    # きらめきもステップごとに進め、描画の頻度で速さが変わらないようにする
+    for frame in range(frame_count - steps + 1, frame_count + 1):
+        world.coins.spawn_sparkles(world.sparkles, frame, camera.active, world.effects_rng)
+        world.sparkles.step()
+    for rect in world.coins.draw(screen, frame_count, camera.cull, offset):
+        add(rect)
+    mark(PHASE_COINS)
+    for rect in world.sparkles.draw(screen, offset):
+        add(rect)
+    mark(PHASE_PARTICLES)
+    for rect in world.enemies.draw(screen, camera.cull, offset, alpha):
+        add(rect)
+    mark(PHASE_ENEMY_DRAW)
+    add(world.player.draw(screen, offset, world.ground, alpha))
+    mark(PHASE_PLAYER_DRAW)
+
+def draw_hud(screen, world, renderer=None):
+    score_text = f"Coins: {world.coins_collected}/{world.coin_count}"
+    hud_rect = screen.blit(resources.text(score_text, BLACK), (12, 12))
+    hud_rect.union_ip(screen.blit(resources.text(score_text, WHITE), (10, 10)))
+    if renderer:
+        renderer.add(hud_rect)
     
-    initial_coin_count = 7
-    coins = [
-        Coin(250, SCREEN_HEIGHT - 60 - 100 - 40),
-        Coin(450, SCREEN_HEIGHT - 60 - 200 - 40),
-        Coin(650, SCREEN_HEIGHT - 60 - 300 - 40),
-        Coin(880, SCREEN_HEIGHT - 60 - 150 - 40),
-        Coin(100, SCREEN_HEIGHT - 60 - 250 - 40),
-        Coin(350, SCREEN_HEIGHT - 60 - 100 - 100 - 10),
-        Coin(550, SCREEN_HEIGHT - 60 - 40),
+    if world.game_over:
+        screen.blit(resources.message_overlay(screen.get_size(), (0, 0, 0, 128),
+                                              "GAME OVER! Press R to Restart", RED,
+                                              (230, 230, 230), (50, 50, 50)), (0, 0))
+        
+    elif world.won:
+        screen.blit(resources.message_overlay(screen.get_size(), (255, 255, 255, 100),
+                                              "YOU WIN! All Coins Collected!", DARK_GREEN,
+                                              (220, 255, 220), GOLD), (0, 0))
+
+# 起動
+# bootstrap() は使うサブシステム（画面とフォント）だけを初期化して画面を作る。
+# 最初のフレームに要る画像の読み込み・縮小・焼き込みとレベルの読み込みは別スレッドで行い、
+# その間はメインスレッドで軽いスプラッシュ画面を出してイベントを処理し続ける。
+# 先読みに失敗した物は、後で使う時に同じ処理をもう一度通るのでそこでエラーになる。
+SPLASH_BAR_SIZE = (320, 12)
+
+def bootstrap(headless=False):
+    global screen, clock
+    if headless:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.display.init()
+    pygame.font.init()
+    # ウィンドウはSCALEDで開き、ウィンドウの大きさへの拡大はSDLに任せる
+    try:
+        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), 0 if headless else pygame.SCALED)
+    except pygame.error:
+        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption(WINDOW_TITLE)
+    clock = pygame.time.Clock()
+    return screen
+
+def startup_tasks(level_path=DEFAULT_LEVEL_PATH, seed=0, size=(SCREEN_WIDTH, SCREEN_HEIGHT)):
+    # (名前, 関数) のリスト。順に実行し、戻り値は名前で引ける
+    results = {}
+    def load_world():
+        results["world"] = World(load_level(level_path), seed=seed)
+        return results["world"]
+    return [
+        ("player", lambda: (assets.sprite(PLAYER_IMAGE, divisor=PLAYER_IMAGE_DIVISOR, colorkey=CREAM),
+                            assets.sprite(PLAYER_IMAGE, divisor=PLAYER_IMAGE_DIVISOR, colorkey=CREAM,
+                                          flip_x=True))),
+        ("enemies", enemy_atlas.build),
+        ("coins", coin_strip.build),
+        ("background", lambda: background.build(size)),
+        ("world", load_world),
+        ("platforms", lambda: bake_world(results["world"])),
     ]
+
+def bake_world(world):
+    # 最初のフレームで作られる物（読み込んだ足場の絵と、影を落とす面の表）を先に作っておき、
+    # スプラッシュの後の最初のフレームから定常状態で描けるようにする
+    world.ground.surface_below(world.player.rect.centerx, world.player.rect.bottom)
+    return [platform.bake() for platform in world.platforms]
+
+class Preloader:
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.results = {}
+        self.completed = 0
+        self.current = None
+        self.error = None
+        self.times = {}
+        self.thread = None
+
+    def run(self):
+        for name, task in self.tasks:
+            self.current = name
+            start_time = time.perf_counter()
+            try:
+                self.results[name] = task()
+            except Exception as e:
+                self.error = e
+                break
+            self.times[name] = time.perf_counter() - start_time
+            self.completed += 1
+        self.current = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="Preloader", daemon=True)
+        self.thread.start()
+
+    @property
+    def done(self):
+        return self.thread is None or not self.thread.is_alive()
+
+    @property
+    def progress(self):
+        return self.completed / max(len(self.tasks), 1)
+
+def draw_splash(screen, progress, label=None):
+    screen.fill(SKY_BLUE)
+    width, height = screen.get_size()
+    title = resources.text("Angel Adventure", WHITE, size=64)
+    screen.blit(title, title.get_rect(center=(width // 2, height // 2 - 40)))
+    bar = pygame.Rect(0, 0, *SPLASH_BAR_SIZE)
+    bar.center = (width // 2, height // 2 + 30)
+    pygame.draw.rect(screen, WHITE, bar, 2)
+    pygame.draw.rect(screen, WHITE, (bar.x, bar.y, int(bar.width * progress), bar.height))
+    if label:
+        text = resources.text(f"Loading {label}...", WHITE, size=24)
+        screen.blit(text, text.get_rect(midtop=(width // 2, bar.bottom + 10)))
+
+def show_splash(screen, loader):
+    # 先読みが終わるまでスプラッシュを出す。ウィンドウを閉じたらFalse
+    loader.start()
+    while not loader.done:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return False
+        draw_splash(screen, loader.progress, loader.current)
+        pygame.display.flip()
+        clock.tick(FPS)
+    loader.thread.join()
+    return True
+
+def main(dirty_rects=False, level_path=DEFAULT_LEVEL_PATH, record_path=None, seed=None, profile_path=None,
+         capture_path=None, capture_drop=CAPTURE_DROP_NEWEST, render_fps=FPS, quality_mode=QUALITY_AUTO,
+         gc_mode=GC_TUNED, alloc_path=None):
+    # render_fps は描画の上限（0なら上限なし）。シミュレーションの速さには影響しない
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    screen = bootstrap()
+    loader = Preloader(startup_tasks(level_path, seed, screen.get_size()))
+    if not show_splash(screen, loader):
+        pygame.quit()
+        sys.exit()
+    if isinstance(loader.error, LevelError):
+        pygame.quit()
+        print(loader.error)
+        sys.exit(1)
+    world = loader.results.get("world") or World(load_level(level_path), seed=seed)
+    quality.budget = 1.0 / (render_fps or FPS)
+    if alloc_path and quality_mode == QUALITY_AUTO:
+        # 記録の負荷で段階が下がると別の描画を調べることになるので、最初の段階に固定する
+        quality_mode = QUALITY_TIERS[0].name
+    quality.set_mode(quality_mode)
+    quality.apply(world)
+    gc_policy.enable(gc_mode)
+    gc_policy.after_load()
+    # 読み込みが済んでから記録を始め、定常状態のフレームだけを見る
+    allocations.enable(alloc_path is not None)
+    recorder = InputRecorder(record_path, seed, level_path) if record_path else None
+    capture = FrameCapture(capture_path, capture_drop, fps=render_fps or FPS) if capture_path else None
     
+    renderer = None
+    if dirty_rects:
+        renderer = DirtyRectRenderer(screen)
+    # 差分矩形描画と録画は画面に直接描いた物を使うので、内部解像度を下げない
+    render_scale = 1.0
+    fixed_size = renderer is not None or capture is not None
+    target = screen
+
+    # F3でプロファイラーの表示、F4で直近のフレームをCSVとトレースに書き出す
+    profiler.enable(profile_path is not None)
+
     running = True
-    game_over = False
+    frame_count = 0
+    restart = False
+    accumulator = 0.0
+    previous_time = time.perf_counter()
     
-    while running:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_r and game_over:
-                    player = Player(100, 400)
-                    enemies = [
-                        Enemy(300, SCREEN_HEIGHT - 60 - 35),
-                        Enemy(500, SCREEN_HEIGHT - 60 - 300 - 35),
-                        Enemy(750, SCREEN_HEIGHT - 60 - 35),
-                    ]
-                    coins = [
-                        Coin(250, SCREEN_HEIGHT - 60 - 100 - 40),
-                        Coin(450, SCREEN_HEIGHT - 60 - 200 - 40),
-                        Coin(650, SCREEN_HEIGHT - 60 - 300 - 40),
-                        Coin(880, SCREEN_HEIGHT - 60 - 150 - 40),
-                        Coin(100, SCREEN_HEIGHT - 60 - 250 - 40),
-                        Coin(350, SCREEN_HEIGHT - 60 - 100 - 100 - 10),
-                        Coin(550, SCREEN_HEIGHT - 60 - 40),
-                    ]
-                    game_over = False
+    # 途中で落ちても、そこまでの記録は再生できるように閉じる
+    try:
+        while running:
+            profiler.begin_frame()
+            frame_start = time.perf_counter()
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                elif event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_r and world.game_over:
+                        # 次のステップで使われるまで覚えておく
+                        restart = True
+                        if renderer:
+                            renderer.invalidate()
+                    elif event.key == pygame.K_F3:
+                        profiler.visible = not profiler.visible
+                        profiler.enable(profiler.visible or profile_path is not None)
+                        if renderer:
+                            renderer.invalidate()
+                    elif event.key == pygame.K_F4 and profiler.count:
+                        stamp = time.strftime("%Y%m%d_%H%M%S")
+                        profiler.export_csv(f"profile_{stamp}.csv")
+                        profiler.export_trace(f"profile_{stamp}.json")
+                        print(f"wrote profile_{stamp}.csv and profile_{stamp}.json")
+            profiler.mark(PHASE_EVENTS)
         
-        if not game_over:
-            if not player.update(platforms, enemies, coins):
-                game_over = True
-            for enemy in enemies:
-                enemy.update(platforms)
-        
-        screen.fill(BLACK)
-        draw_background(screen)
-        
-        for platform in platforms:
-            platform.draw(screen)
-        for coin in coins:
-            coin.draw(screen)
-        for enemy in enemies:
-            enemy.draw(screen)
-            
-        player.draw(screen)
+            # 経過した実時間の分だけ固定の刻みでシミュレーションを進める
+            now = time.perf_counter()
+            accumulator += now - previous_time
+            previous_time = now
+            keys = pygame.key.get_pressed()
+            steps = 0
+            finished = world.game_over or world.won
+            while accumulator >= SIM_DT:
+                if steps == MAX_CATCH_UP_STEPS:
+                    accumulator %= SIM_DT
+                    break
+                inputs = Inputs.from_keys(keys, restart)
+                if restart and world.game_over:
+                    frame_count = 0
+                restart = False
+                world.step(inputs)
+                if recorder:
+                    recorder.record(inputs, world)
+                frame_count += 1
+                steps += 1
+                accumulator -= SIM_DT
+            game_over = world.game_over
+            if (game_over or world.won) != finished:
+                gc_policy.transition()
+            scale = 1.0 if fixed_size else quality.tier.scale
+            if scale != render_scale:
+                render_scale = scale
+                target = render_target(screen, scale)
+            draw_world(target, world, frame_count, renderer, accumulator / SIM_DT, steps)
+            draw_hud(target, world, renderer)
         
-        font = pygame.font.Font(None, 36)
-        score_text = f"Coins: {initial_coin_count - len(coins)}/{initial_coin_count}"
-        shadow_surface_font = font.render(score_text, True, BLACK)
-        screen.blit(shadow_surface_font, (12, 12))
-        score_surface = font.render(score_text, True, WHITE)
-        screen.blit(score_surface, (10, 10))
+            if profiler.visible:
+                profiler_rect = profiler.draw(target)
+                if renderer:
+                    renderer.add(profiler_rect)
+            profiler.mark(PHASE_HUD)
         
-        if game_over:
-            overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
-            overlay.fill((0, 0, 0, 128))
-            screen.blit(overlay, (0, 0))
-            game_over_text = font.render("GAME OVER! Press R to Restart", True, RED)
-            text_rect = game_over_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
-            bg_rect = text_rect.inflate(20, 20)
-            pygame.draw.rect(screen, (230, 230, 230), bg_rect, border_radius=10)
-            pygame.draw.rect(screen, (50, 50, 50), bg_rect, 3, border_radius=10)
-            screen.blit(game_over_text, text_rect)
-            
-        elif len(coins) == 0:
-            overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
-            overlay.fill((255, 255, 255, 100))
-            screen.blit(overlay, (0,0))
-            win_text = font.render("YOU WIN! All Coins Collected!", True, DARK_GREEN)
-            text_rect = win_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
-            bg_rect = text_rect.inflate(20, 20)
-            pygame.draw.rect(screen, (220, 255, 220), bg_rect, border_radius=10)
-            pygame.draw.rect(screen, GOLD, bg_rect, 3, border_radius=10)
-            screen.blit(win_text, text_rect)
-        
-        pygame.display.flip()
-        clock.tick(FPS)
+            if renderer:
+                renderer.present(full=game_over or world.won)
+            else:
+                if target is not screen:
+                    target.present(screen)
+                pygame.display.flip()
+            if capture:
+                capture.capture(screen)
+            profiler.mark(PHASE_FLIP)
+            work = time.perf_counter() - frame_start
+            if quality.record(work):
+                quality.apply(world)
+                if renderer:
+                    renderer.invalidate()
+            gc_policy.idle(quality.budget - work)
+            allocations.end_frame()
+            clock.tick(render_fps)
+            profiler.mark(PHASE_TICK)
+            profiler.end_frame()
+    finally:
+        if recorder:
+            recorder.close(world)
     
+    if profile_path:
+        profiler.export(profile_path)
+    if capture:
+        capture.close()
+        print(capture.summary())
+    if alloc_path:
+        allocations.enable(False)
+        allocations.export(alloc_path)
+        allocations.print_summary()
+    gc_policy.disable()
+    world.level.close()
     pygame.quit()
     sys.exit()
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="エンジェルアドベンチャー")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="update only the changed screen regions instead of flipping the full frame")
+    parser.add_argument("--headless", type=int, nargs="?", const=100000, metavar="STEPS",
+                        help="run the simulation without a window as fast as possible and report throughput")
+    parser.add_argument("--level", metavar="PATH",
+                        help="level to play (.json or packed .szl); with --replay, use it instead of the recorded level")
+    parser.add_argument("--pack-level", nargs=2, metavar=("SRC", "DEST"),
+                        help="convert a .json level into the packed .szl format")
+    parser.add_argument("--generate-level", nargs=2, metavar=("SCREENS", "DEST"),
+                        help="write a generated packed level SCREENS screens wide")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="profile every frame and write the last frames to PATH on exit "
+                             "(.csv, or .json for a Chrome trace)")
+    parser.add_argument("--seed", type=int, help="random seed for the world (default: random)")
+    parser.add_argument("--record", metavar="PATH", help="record the inputs of this session to a replay file")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="replay a recorded session headless at full speed and verify its checkpoints")
+    parser.add_argument("--fps", type=int, default=FPS,
+                        help=f"frame rate cap for rendering, 0 for uncapped (the simulation always runs at {SIM_RATE} steps/s)")
+    parser.add_argument("--quality", choices=(QUALITY_AUTO,) + tuple(tier.name for tier in QUALITY_TIERS),
+                        default=QUALITY_AUTO,
+                        help="rendering quality (default: auto, which lowers the quality when frames miss their budget)")
+    parser.add_argument("--gc", choices=(GC_TUNED, GC_DEFAULT), default=GC_TUNED,
+                        help="garbage collection policy (default: tuned, which collects only at transitions "
+                             "and on frames with time to spare)")
+    parser.add_argument("--trace-alloc", metavar="PATH",
+                        help="record the allocations kept by each frame and every GC pause, and write them to "
+                             "PATH as JSON on exit (slow; --quality auto is pinned to the highest tier)")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="write every frame to PATH (.y4m, .raw rgb24, or a directory or %%06d pattern for PNGs); "
+                             "with --replay, render the replay headless as fast as possible")
+    parser.add_argument("--capture-drop", choices=CAPTURE_DROP_POLICIES, default=None,
+                        help="what to do when the writer falls behind (default: drop-newest while playing, "
+                             "block when capturing a replay)")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.pack_level:
+        try:
+            Level.from_json(args.pack_level[0]).save(args.pack_level[1])
+        except (LevelError, OSError) as e:
+            print(e)
+            sys.exit(1)
+    elif args.generate_level:
+        generate_level(int(args.generate_level[0])).save(args.generate_level[1])
+    elif args.replay:
+        capture = None
+        if args.capture:
+            # 書き出すフレームを描くための画面（ウィンドウは開かない）
+            bootstrap(headless=True)
+            capture = FrameCapture(args.capture, args.capture_drop or CAPTURE_BLOCK)
+        try:
+            result = run_replay(args.replay, level_path=args.level, capture=capture)
+        except (ReplayError, LevelError) as e:
+            print(e)
+            sys.exit(1)
+        finally:
+            if capture:
+                capture.close()
+        if capture:
+            print(capture.summary())
+        print(f"replayed {result.frames} frames, {result.checkpoints} checkpoints OK "
+              f"in {result.elapsed:.2f}s ({result.frames / max(result.elapsed, 1e-9):.0f} frames/s)")
+    elif args.headless:
+        start_time = time.perf_counter()
+        try:
+            run_headless(args.headless, world=World(load_level(args.level or DEFAULT_LEVEL_PATH)))
+        except LevelError as e:
+            print(e)
+            sys.exit(1)
+        elapsed = time.perf_counter() - start_time
+        print(f"{args.headless} steps in {elapsed:.2f}s ({args.headless / elapsed:.0f} steps/s)")
+    else:
+        main(dirty_rects=args.dirty_rects, level_path=args.level or DEFAULT_LEVEL_PATH, record_path=args.record, seed=args.seed,
+             profile_path=args.profile, capture_path=args.capture,
+             capture_drop=args.capture_drop or CAPTURE_DROP_NEWEST, render_fps=args.fps,
+             quality_mode=args.quality, gc_mode=args.gc, alloc_path=args.trace_alloc)
\ No newline at end of file